@@ -1,68 +1,509 @@
-import socket
+import asyncio
 import threading
 import time
 import json
+import struct
 import hashlib
 import random
 import sys
 import base64
+import hmac
+import os
+import multiprocessing
+import concurrent.futures
+import logging
+import logging.handlers
+import queue
+import atexit
+import collections
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives.asymmetric import utils
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization
+from common import FRAME_HEADER, RECV_BUFFER_SIZE, FrameDecoder, load_private_key, sign_bytes, load_public_key, verify_signature, verify_batch, TimerWheel, WriteAheadLog, PeerQueue
 GREEN = "\033[92m"; RED = "\033[91m"; BLUE = "\033[34m"; RESET = "\033[0m"
 
-h = 1; H = 20; seq_no = 1
+# a message is sent as the lengths of its body, proof and embedded request, the kind of proof,
+# then the three byte strings; the body bytes are exactly the bytes that were signed or MACed
+MESSAGE_HEADER = struct.Struct('>IBHI')
+PROOF_NONE = 0; PROOF_SIGNATURE = 1; PROOF_AUTHENTICATOR = 2
+
+def canonical_encoding(fields):
+    """the one byte encoding of a message body: compact json with sorted keys."""
+    return json.dumps(fields, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+class Message:
+    """a message decoded once: its fields, the bytes its signature or authenticator covers and,
+    computed on first use and then carried along, its digest and its wire encoding."""
+    __slots__ = ("phase", "v", "n", "d", "i", "fields", "raw", "signature", "authenticator", "request",
+                 "_digest", "_wire", "_embedded")
+
+    def __init__(self, fields, raw=None, signature=None, authenticator=None, request=None):
+        self.fields = fields
+        self.phase = fields["phase"]
+        self.v = fields.get("v"); self.n = fields.get("n"); self.d = fields.get("d"); self.i = fields.get("i")
+        self.raw = raw if raw is not None else canonical_encoding(fields)
+        self.signature = signature
+        self.authenticator = authenticator
+        self.request = request # the client request carried by a PRE-PREPARE
+        self._digest = None; self._wire = None; self._embedded = None
+
+    @property
+    def digest(self):
+        """sha256 of the canonical body, computed once."""
+        if self._digest is None: self._digest = hashlib.sha256(self.raw).hexdigest()
+        return self._digest
+
+    def encode(self):
+        """the wire encoding of the message, computed once however many peers it is sent to."""
+        if self._wire is None:
+            if self.signature is not None: kind, proof = PROOF_SIGNATURE, self.signature
+            elif self.authenticator is not None: kind, proof = PROOF_AUTHENTICATOR, canonical_encoding(self.authenticator)
+            else: kind, proof = PROOF_NONE, b""
+            request = self.request.raw if self.request is not None else b""
+            self._wire = MESSAGE_HEADER.pack(len(self.raw), kind, len(proof), len(request)) + self.raw + proof + request
+        return self._wire
+
+    @classmethod
+    def decode(cls, payload):
+        """decode the wire encoding of a message; the body and request are parsed exactly once."""
+        body_length, kind, proof_length, request_length = MESSAGE_HEADER.unpack_from(payload)
+        start = MESSAGE_HEADER.size
+        raw = payload[start:start + body_length]; start += body_length
+        proof = payload[start:start + proof_length]; start += proof_length
+        request_raw = payload[start:start + request_length]
+        request = cls(json.loads(request_raw), raw=request_raw) if request_length else None
+        message = cls(json.loads(raw), raw=raw, request=request,
+                      signature=proof if kind == PROOF_SIGNATURE else None,
+                      authenticator=json.loads(proof) if kind == PROOF_AUTHENTICATOR else None)
+        message._wire = payload
+        return message
+
+    def to_json(self):
+        """the signed message as a json object, to be embedded in the body of another message."""
+        embedded = {"m": self.raw.decode('utf-8'), "s": base64.b64encode(self.signature).decode('utf-8')}
+        if self.request is not None: embedded["r"] = self.request.raw.decode('utf-8')
+        return embedded
+
+    @classmethod
+    def from_json(cls, embedded):
+        raw = embedded["m"].encode('utf-8')
+        request = None
+        if "r" in embedded:
+            request_raw = embedded["r"].encode('utf-8')
+            request = cls(json.loads(request_raw), raw=request_raw)
+        return cls(json.loads(raw), raw=raw, signature=base64.b64decode(embedded["s"].encode('utf-8')), request=request)
+
+    def embedded(self, key):
+        """the signed messages embedded under key (as in VIEW-CHANGE and NEW-VIEW), decoded once."""
+        if self._embedded is None: self._embedded = {}
+        if key not in self._embedded: self._embedded[key] = [Message.from_json(item) for item in self.fields[key]]
+        return self._embedded[key]
+
+    def __repr__(self):
+        return self.raw.decode('utf-8')
+
+def encode_frame(message):
+    """encode a message as a 4-byte big-endian length followed by its wire encoding."""
+    payload = message.encode()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+h = 1; H = 20
 max_faulty_nodes = 0
+# the timeout of requests and view changes starts at timeout seconds; once batches execute it follows their
+# latency from PRE-PREPARE to execution, as its moving average (gain latency_gain) plus timeout_deviations
+# times its mean deviation (gain latency_deviation_gain), within [min_timeout, max_timeout] seconds, and it
+# doubles with every consecutive view change until a batch executes again
 timeout = 7
+min_timeout = 0.5; max_timeout = 60
+latency_gain = 0.125; latency_deviation_gain = 0.25; timeout_deviations = 4
+# the primary orders up to batch_size operations under one sequence number,
+# waiting at most batch_timeout seconds for a batch to fill up
+batch_size = 1; batch_timeout = 0.05
+# COMMIT messages carry a vector of HMACs (one per replica, keyed with the pairwise session keys agreed
+# during the handshake) instead of a signature; PRE-PREPAREs and PREPAREs stay signed, since a VIEW-CHANGE
+# passes them on as the proof that a request was prepared
+use_authenticators = True
+# with collector_mode set, PREPAREs and COMMITs are signed and sent only to the collector of their view
+# (its primary), which forwards 2f matching PREPAREs, and later 2f + 1 COMMITs, to all replicas as one
+# certificate: O(n) messages per sequence number instead of O(n^2). All replicas of a cluster must agree on it
+collector_mode = False
+# every peer connection has an outbound queue of at most outbound_queue_size frames, drained by a writer
+# task of its own that sends all the frames queued meanwhile as one vectored write; a broadcast only
+# queues its frame for every peer, so a slow peer delays nobody but itself, and once its queue is full
+# the frames to it are dropped (the protocol recovers them like lost messages)
+outbound_queue_size = 10000
+# of every pair of replicas, the one with the lower id dials the other and the connection carries the
+# messages of both; a connection that breaks is dialed again after reconnect_delay seconds, twice as long
+# after every failure up to reconnect_max_delay, while the messages to the peer wait in its queue
+reconnect_delay = 0.1
+reconnect_max_delay = 5
+# the protocol timeouts (of requests, view changes and state transfers) of a replica share one hashed
+# timer wheel of timer_slots slots, each timer_tick seconds long, instead of one loop timer each
+timer_tick = 0.01
+timer_slots = 1024
+# every checkpoint_interval sequence numbers the replicas exchange signed CHECKPOINT messages;
+# once 2f + 1 of them match, the checkpoint is stable, the watermarks move to (n, n + H - h)
+# and the log below n is discarded
+checkpoint_interval = 5
+# a client that gets no f + 1 matching replies within client_timeout seconds retransmits its
+# request to all replicas
+client_timeout = 10
+# a client has at most client_window requests outstanding, and the replicas keep the replies of the last
+# client_window requests executed for each client, so any outstanding request that was executed is answered again
+client_window = 64
+# the replica that equivocates whenever it is the primary, as in the assignment's scenario (None: all honest)
+malicious_primary = 0
+
+# signatures are verified in a pool of worker processes (inline when there is a single core),
+# and the result for every (sender, message, signature) seen recently is cached
+verification_workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+verification_cache_size = 100000
+
+# a replica that learns of a stable checkpoint it has not reached fetches that checkpoint's state
+# from the replicas that signed it: the state is split into chunks of state_chunk_size characters,
+# a checkpoint digest covers the digests of the chunks, and the missing chunks are requested from
+# several replicas at once, each checked against its digest. A replica that falls behind its window
+# fetches at once, one that is merely slow only if it has not caught up after state_transfer_delay
+# seconds; chunks that do not arrive within state_transfer_timeout seconds are asked from others
+state_chunk_size = 4096
+state_transfer_delay = 1
+state_transfer_timeout = 2
+
+# with wal_dir set, a replica appends the messages it logs, the operations it executes, its replies,
+# view changes and stable checkpoints to a write-ahead log in wal_dir, and sends nothing before the
+# records it depends on are on disk; the appends are made durable in groups, one fsync per group.
+# Every snapshot_interval sequence numbers a stable checkpoint also writes a snapshot of the replica
+# and starts a new log segment, so a restarted replica loads the snapshot and replays only the tail.
+wal_dir = None
+snapshot_interval = 50
+
+# every node counts its messages and times its phases; with metrics_port set, replica i serves the
+# metrics in the Prometheus text format at http://localhost:(metrics_port + i)/metrics
+metrics_port = None
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# the nodes log through a queue to a background thread; below log_level nothing is formatted, and
+# with log_sampling = k only one in k DEBUG records of each kind (per message, per phase) is kept
+log_level = logging.INFO
+log_sampling = 1
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+logger = logging.getLogger("pbft")
+log_listener = None
+
+# nodes sign with Ed25519 (or 2048-bit RSA-PSS) keys kept in keystore_dir across restarts
+signature_scheme = "ed25519"
+keystore_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keys")
+
+class SamplingFilter(logging.Filter):
+    """keep one in every rate DEBUG records of each format string; records of other levels all pass."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG: return True
+        count = self.seen.get(record.msg, 0)
+        self.seen[record.msg] = count + 1
+        return count % self.rate == 0
+
+def configure_logging(level=None, sampling=None, stream=None):
+    """log at level through a queue whose background thread writes the records to stream (stdout by default)."""
+    global log_listener
+    if log_listener: log_listener.stop()
+    for handler in list(logger.handlers): logger.removeHandler(handler)
+    for log_filter in list(logger.filters): logger.removeFilter(log_filter)
+    logger.setLevel(log_level if level is None else level)
+    logger.propagate = False
+    sampling = log_sampling if sampling is None else sampling
+    if sampling > 1: logger.addFilter(SamplingFilter(sampling))
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_listener = logging.handlers.QueueListener(records, handler)
+    log_listener.start()
+    atexit.register(log_listener.stop) # write out what is still queued
+
+def encode_message(message):
+    """a message as text, for the json records of the write-ahead log and its snapshots."""
+    return base64.b64encode(message.encode()).decode('utf-8')
+
+def decode_message(text):
+    return Message.decode(base64.b64decode(text.encode('utf-8')))
+
+class Histogram:
+    """the cumulative bucket counts, the sum and the count of the observed values."""
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS); self.sum = 0.0; self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound: self.counts[index] += 1
+        self.sum += value; self.count += 1
+
+class Metrics:
+    """the counters, gauges and histograms of one node, each series keyed by (name, labels)."""
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # functions that set gauges, such as queue depths, whenever the metrics are read
+        self.collectors = []
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def collect(self):
+        for collector in self.collectors: collector()
+
+    @staticmethod
+    def series(name, labels):
+        if not labels: return name
+        return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def snapshot(self):
+        """a copy of all the series, by their Prometheus name, for programs such as the benchmark."""
+        self.collect()
+        return {"counters": {self.series(*key): value for key, value in self.counters.items()},
+                "gauges": {self.series(*key): value for key, value in self.gauges.items()},
+                "histograms": {self.series(*key): {"count": histogram.count, "sum": histogram.sum,
+                                                   "buckets": dict(zip(LATENCY_BUCKETS, histogram.counts))}
+                               for key, histogram in self.histograms.items()}}
+
+    def render(self):
+        """all the series in the Prometheus text exposition format."""
+        self.collect()
+        lines = []; typed = set()
+        def declare(name, kind):
+            if name not in typed: typed.add(name); lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter"); lines.append(f"{self.series(name, labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge"); lines.append(f"{self.series(name, labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                lines.append(f"{self.series(name + '_bucket', labels + (('le', bound),))} {count}")
+            lines.append(f"{self.series(name + '_bucket', labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{self.series(name + '_sum', labels)} {histogram.sum}")
+            lines.append(f"{self.series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
 
 class Node:
+    # the transport: asyncio streams over TCP, replaced per node by the simulator's virtual network
+    open_connection = staticmethod(asyncio.open_connection)
+    start_server = staticmethod(asyncio.start_server)
+
     def __init__(self, node_id, nodes_num):
         self.node_id = node_id
+        self.nodes_num = nodes_num
         self.message_log = []
+        # index of the log: client requests by digest, the accepted PRE-PREPARE digest by (v, n)
+        # and, for each (v, n, d, phase), the logged PREPARE/COMMIT messages by replica id
+        self.requests = {}
+        self.preprepares = {}
+        self.certificates = {}
+        # (v, n, d) instances that already broadcast their COMMIT or executed their request
+        self.commits_sent = set()
+        self.executed = set()
+        # the node's state is only ever touched on its event loop; other threads go through call()
+        self.pending_operations = []
+        self.batch_timer = None
         self.state = "$"
         self.view = 0
-        self.timer = None
-        self.is_primary = (self.view % nodes_num == node_id)
+        # every sequence number inside the watermark window (h, H) can be in flight at once;
+        # committed batches wait in self.committed until all lower sequence numbers are executed
+        self.h = h; self.H = H
+        self.seq_no = h
+        self.last_executed = h
+        self.committed = {}
+        self.timers = {}
+        # when the timer of each sequence number started, the moving average and mean deviation of the
+        # latency from PRE-PREPARE to execution, and the number of view changes since a batch last executed
+        self.timer_starts = {}
+        self.latency_average = None; self.latency_deviation = None
+        self.view_change_backoff = 0
+        # the state after each checkpointed sequence number, the signed CHECKPOINT messages by
+        # (n, d) and the latest stable checkpoint with its 2f + 1 signed messages as proof
+        self.checkpoint_states = {}
+        self.checkpoints = {}
+        # our latest signed CHECKPOINT, sent again whenever the replicas may have missed it
+        self.checkpoint_message = None
+        # the digests of the complete chunks of the state, which never change as the state only grows
+        self.chunk_digests = []
+        self.stable_checkpoint = (h, self.get_state_digest("$", {}), {})
+        # signed PRE-PREPAREs by (v, n), carried as evidence in VIEW-CHANGE messages; the signed
+        # VIEW-CHANGE messages by view; view_active is False between leaving a view and its NEW-VIEW
+        self.preprepare_messages = {}
+        self.view_changes = {}
+        self.view_active = True
+        self.new_view_timer = None
+        # the wheel that keeps the timeouts, created on the node's loop when the first one is set
+        self.timer_wheel = None
+        # the NEW-VIEW message of the current view, which proves it to replicas that missed it
+        self.last_new_view = None
+        self.view_change_started = None
+        self.last_failover = None
+        # the signed REPLYs of the last client_window requests executed for each client as {t: message}, the
+        # connections of the clients, the (c, t) requests this primary is ordering and the timers of relayed requests
+        self.last_replies = {}
+        self.clients = {}
+        self.submitted_requests = set()
+        self.request_timers = {}
+        # the outbound queue of every peer replica by port, whether or not it is connected right now
         self.peers = {}
-        self.private_key, self.public_key = self.generate_rsa_keys()
-        threading.Thread(target=self.check_if_is_primary, args=()).start()
-    
-    def check_if_is_primary(self):
-        time.sleep(6) # wait a little to make sure all the nodes start to work
-        operations = [1, 2, 3, 4]
-        index = 0
-        while index < len(operations):
-            self.is_primary = (self.view % nodes_num == node_id)
-            if self.is_primary:
-                self.broadcast_preprepare_message(operations[index])
-            index = index + 1; time.sleep(13)
-
-    def generate_rsa_keys(self):
-        """generate the pair of public key and private key"""
-        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        # our handshake, signed once for all connections, and the session key share each replica last sent
+        self.handshake = None
+        self.session_shares = {}
+        self.verification_pool = None
+        self.verification_cache = {}
+        self.private_key, self.public_key = self.load_keys()
+        self.string_public_key = self.get_string_public_key()
+        # public keys of the other replicas and the pairwise session keys, by replica id, and the public keys of
+        # the clients, by client id; a client id is always a "client-..." string, never a replica's number
+        self.public_keys = {}
+        self.session_keys = {}
+        self.client_keys = {}
+        self.public_keys[self.node_id] = base64.b64decode(self.string_public_key.encode('utf-8'))
+        self.session_private_key = x25519.X25519PrivateKey.generate()
+        # when each sequence number reached its last phase (pre-prepared, prepared or committed)
+        self.phase_times = {}
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_gauges)
+        # the state transfer in progress (None if there is none) and the timer that may start one
+        self.transfer = None
+        self.transfer_timer = None
+        # the write-ahead log (None unless wal_dir is set) and the sequence number of the latest snapshot
+        self.wal = None
+        self.last_snapshot = h
+
+    def collect_gauges(self):
+        """the view and the depth of the node's queues at the moment the metrics are read."""
+        metrics = self.metrics
+        metrics.set("pbft_view", self.view)
+        metrics.set("pbft_last_executed", self.last_executed)
+        metrics.set("pbft_in_flight", max(self.seq_no, self.last_executed) - self.last_executed)
+        metrics.set("pbft_queue_depth", len(self.pending_operations), (("queue", "pending_operations"),))
+        metrics.set("pbft_queue_depth", len(self.committed), (("queue", "committed"),))
+        metrics.set("pbft_queue_depth", len(self.message_log), (("queue", "message_log"),))
+        metrics.set("pbft_pending_timeouts", self.timer_wheel.pending if self.timer_wheel else 0)
+        metrics.set("pbft_timeout_seconds", self.current_timeout())
+        for peer_port, outbox in self.peers.items():
+            metrics.set("pbft_peer_connected", int(outbox.writer is not None), (("peer", peer_port),))
+            metrics.set("pbft_outbound_queue_depth", len(outbox.frames), (("peer", peer_port),))
+            metrics.set("pbft_outbound_writes", outbox.writes, (("peer", peer_port),))
+            metrics.set("pbft_outbound_dropped", outbox.dropped, (("peer", peer_port),))
+            transport = getattr(outbox.writer, "transport", None)
+            if transport: metrics.set("pbft_send_buffer_bytes", transport.get_write_buffer_size(), (("peer", peer_port),))
+
+    def metrics_snapshot(self):
+        """the node's metrics as a dictionary; call it on the node's loop, e.g. node.call(node.metrics_snapshot)."""
+        return self.metrics.snapshot()
+
+    def observe_phase(self, n, phase):
+        """record the time sequence number n spent reaching phase since its previous one."""
+        now = self.loop.time()
+        previous = self.phase_times.get(n)
+        if previous is not None: self.metrics.observe("pbft_phase_seconds", now - previous, (("phase", phase),))
+        if phase == "executed": self.phase_times.pop(n, None)
+        else: self.phase_times[n] = now
+
+    def load_keys(self):
+        """load the pair of private key and public key from the keystore."""
+        private_key = load_private_key(keystore_dir, f"node-{self.node_id}", signature_scheme)
         public_key = private_key.public_key()
         return private_key, public_key
 
-    def sign_message(self, string_message):
-        """sign the message to ensure its validity."""
-        byte_message = string_message.encode('utf-8')
-        signature = self.private_key.sign(byte_message,
-                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                hashes.SHA256()
-        ); signature_base64 = base64.b64encode(signature).decode('utf-8')
-        return signature_base64
+    def sign_message(self, fields, request=None):
+        """encode the fields of a message once and sign the encoded bytes."""
+        message = Message(fields, request=request)
+        start = time.perf_counter()
+        message.signature = sign_bytes(self.private_key, message.raw)
+        self.metrics.observe("pbft_sign_seconds", time.perf_counter() - start)
+        return message
 
-    def verify_signature(self, public_key, string_message, signature_base64):
+    def verify_signature(self, public_key, byte_message, signature):
         """check the validity of the message by verifying its signature."""
-        try:
-            byte_message = string_message.encode('utf-8')
-            signature = base64.b64decode(signature_base64.encode('utf-8'))
-            public_key.verify(signature, byte_message,
-                    padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                    hashes.SHA256()
-            ); return True
-        except Exception as e: return False
+        return verify_signature(public_key, byte_message, signature)
+
+    def verify_message(self, public_key_pem, message):
+        """verify the signature of one message, reusing the result if it was already verified."""
+        if public_key_pem is None or message.signature is None: return False
+        key = (public_key_pem, hashlib.sha256(message.raw + message.signature).digest())
+        valid_signature = self.verification_cache.get(key)
+        if valid_signature is None:
+            start = time.perf_counter()
+            valid_signature = self.verification_cache[key] = self.verify_signature(
+                load_public_key(public_key_pem), message.raw, message.signature)
+            self.metrics.observe("pbft_verify_seconds", time.perf_counter() - start)
+        return valid_signature
+
+    def authenticator(self, byte_message):
+        """compute the MAC of a message for every replica we share a session key with."""
+        return {str(peer_id): hmac.new(key, byte_message, hashlib.sha256).hexdigest()
+                for peer_id, key in self.session_keys.items()}
+
+    def verify_authenticator(self, message, peer_id):
+        """check our entry of the authenticator of a message received from peer_id: the MAC must be keyed with the
+        session key of the replica named by the message's i, and that replica must be the one that sent it."""
+        if message.i != peer_id: return False
+        key = self.session_keys.get(message.i)
+        authenticator = message.authenticator
+        if key is None or not isinstance(authenticator, dict) or not isinstance(authenticator.get(str(self.node_id)), str): return False
+        expected = hmac.new(key, message.raw, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, authenticator[str(self.node_id)])
+
+    async def verify_messages(self, messages, peer_id):
+        """verify the authenticators or signatures of a batch of messages from one sender, skipping those already verified."""
+        public_key_pem = self.public_keys.get(peer_id) # None for a client, whose requests accept_request checks
+        results = [None] * len(messages); pending = []
+        for index, message in enumerate(messages):
+            if message.authenticator is not None:
+                results[index] = self.verify_authenticator(message, peer_id)
+                continue
+            if message.signature is None or public_key_pem is None:
+                results[index] = False; continue
+            key = (public_key_pem, hashlib.sha256(message.raw + message.signature).digest())
+            results[index] = self.verification_cache.get(key)
+            if results[index] is None: pending.append((index, key))
+        self.metrics.inc("pbft_verification_cache_hits_total", value=len(messages) - len(pending))
+        if pending:
+            batch = [(public_key_pem, messages[index].raw, messages[index].signature) for index, key in pending]
+            start = time.perf_counter()
+            if self.verification_pool: verified = await self.loop.run_in_executor(self.verification_pool, verify_batch, batch)
+            else: verified = verify_batch(batch)
+            # the time per signature, including the trip to the worker process
+            elapsed = (time.perf_counter() - start) / len(batch)
+            for item in batch: self.metrics.observe("pbft_verify_seconds", elapsed)
+            if len(self.verification_cache) + len(pending) > verification_cache_size: self.verification_cache.clear()
+            for (index, key), valid in zip(pending, verified):
+                results[index] = self.verification_cache[key] = valid
+        return results
+
+    def get_handshake(self):
+        """get the handshake message: our id, public key and signed session key share (signed once, sent on every connection)."""
+        if self.handshake: return self.handshake
+        session_key = self.session_private_key.public_key().public_bytes(
+                                encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+        signature = sign_bytes(self.private_key, session_key)
+        self.handshake = Message({"phase": "HANDSHAKE", "public-key": self.string_public_key, "id": self.node_id,
+                                  "session-key": base64.b64encode(session_key).decode('utf-8'),
+                                  "signature": base64.b64encode(signature).decode('utf-8')})
+        return self.handshake
 
     def get_string_public_key(self):
         """get the node's public key to send it to other nodes."""
@@ -72,259 +513,1297 @@ class Node:
         public_key_pem_base64 = base64.b64encode(public_key_pem).decode('utf-8')
         return public_key_pem_base64
     
-    def receive_public_key(self, conn):
-        """receive the public key of each node."""
-        message = conn.recv(1024).decode('utf-8')
-        json_message = json.loads(message)
-        print(f"{GREEN}Node {self.node_id} received the public key of the node conncted!{RESET}")
+    async def receive_frames(self, reader):
+        """yield, for every read from the stream, the list of messages it completed."""
+        decoder = FrameDecoder(Message.decode)
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data: return
+            messages = decoder.feed(data)
+            if messages: yield messages
+
+    def receive_public_key(self, handshake):
+        """receive the public key of each node and derive the session key shared with it."""
+        logger.debug(f"{GREEN}Node %s received the public key of the node connected!{RESET}", self.node_id)
+        json_message = handshake.fields
+        peer_id = json_message["id"]
         public_key_pem = base64.b64decode(json_message["public-key"].encode('utf-8'))
-        public_key = serialization.load_pem_public_key(public_key_pem)
-        return public_key
+        # the first key a node presents for an id stays its key: a handshake that would replace it is refused
+        if json_message.get("client"):
+            if not (isinstance(peer_id, str) and peer_id.startswith("client-")): raise ValueError(f"{peer_id!r} is not a client id")
+            if self.client_keys.setdefault(peer_id, public_key_pem) != public_key_pem:
+                raise ValueError(f"client {peer_id} presented another public key than before")
+            return peer_id # clients do not take part in the authenticators
+        if not (isinstance(peer_id, int) and 0 <= peer_id < self.nodes_num and peer_id != self.node_id):
+            raise ValueError(f"{peer_id!r} is not the id of a peer replica")
+        known_key = (self.public_keys.get(peer_id) == public_key_pem)
+        if peer_id in self.public_keys and not known_key: raise ValueError(f"node {peer_id} presented another public key than before")
+        self.public_keys[peer_id] = public_key_pem
+        session_key = base64.b64decode(json_message["session-key"].encode('utf-8'))
+        # a replica that reconnects with the keys of its previous connection keeps the session key derived then
+        if known_key and self.session_shares.get(peer_id) == session_key and peer_id in self.session_keys: return peer_id
+        signature = base64.b64decode(json_message["signature"].encode('utf-8'))
+        if self.verify_signature(load_public_key(public_key_pem), session_key, signature):
+            peer_session_key = x25519.X25519PublicKey.from_public_bytes(session_key)
+            shared_secret = self.session_private_key.exchange(peer_session_key)
+            self.session_keys[peer_id] = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                                              info=b"pbft session key").derive(shared_secret)
+            self.session_shares[peer_id] = session_key
+        else: logger.warning(f"{RED}Node %s rejected the session key of node %s!{RESET}", self.node_id, peer_id)
+        return peer_id
 
     def start(self, host, port):
-        """start the node and listen for incoming connections."""
-        server_thread = threading.Thread(target=self.listen_for_connections, args=(host, port))
-        server_thread.start()
+        """start the node's event loop and listen for incoming connections."""
+        self.loop = asyncio.new_event_loop()
+        self.base_port = port - self.node_id # replica i listens on base_port + i
+        if wal_dir: self.recover()
+        if verification_workers:
+            self.verification_pool = concurrent.futures.ProcessPoolExecutor(
+                verification_workers, mp_context=multiprocessing.get_context("spawn"))
+            self.verification_pool.submit(verify_batch, []) # start the workers before the first batch
+        threading.Thread(target=self.loop.run_forever, args=()).start()
+        self.call(self.listen_for_connections, host, port)
+        if metrics_port is not None: self.call(self.serve_metrics, host, metrics_port + self.node_id)
 
-    def listen_for_connections(self, host, port):
-        """listen for incoming messages from other nodes."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(10)
-        print(f"Node {self.node_id} listening on port {port}")
+    def call(self, function, *args):
+        """run a function or coroutine on the node's event loop from another thread and wait for its result."""
+        async def invoke():
+            result = function(*args)
+            if asyncio.iscoroutine(result): result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(invoke(), self.loop).result()
 
-        while True:
-            conn, addr = server_socket.accept()
-            ip_, port_ = addr
-            public_key_pem = self.receive_public_key(conn)
-            # for each connected node, we will run a thread to continuesly receive the messsages
-            # and handle them based on the message type (PREPARE, COMMIT, etc).
-            threading.Thread(target=self.handle_message, args=(conn, public_key_pem)).start()
+    async def listen_for_connections(self, host, port):
+        """listen for incoming connections from other nodes."""
+        self.server = await self.start_server(self.handle_message, host, port)
+        logger.info("Node %s listening on port %s", self.node_id, port)
     
-    def handle_message(self, conn, public_key_pem):
-        """receive the messages from other nodes."""
-        while True:
-            message = conn.recv(1024).decode('utf-8')
-            message = json.loads(message)
-            print(f"Node {self.node_id} received message: {message}")
-            # process each message based on its type and the state of the protocol
-            threading.Thread(target=self.process_message, args=(message, public_key_pem)).start()
-        
-    def connect_to_peer(self, peer_host, peer_port):
-        """connect to a peer node and send the public key."""
+    async def serve_metrics(self, host, port):
+        """serve the metrics over HTTP for Prometheus to scrape."""
+        self.metrics_server = await asyncio.start_server(self.handle_metrics_request, host, port)
+        logger.info("Node %s serves its metrics on http://%s:%s/metrics", self.node_id, host, port)
+
+    async def handle_metrics_request(self, reader, writer):
+        """answer one HTTP request: the metrics for GET /metrics, 404 for anything else."""
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((peer_host, peer_port))
-            self.peers[peer_port] = peer_socket
-            print(f"Node {self.node_id} connected to peer {peer_port}")
-            self.send_message(peer_port, {"public-key" : self.get_string_public_key()})
-            print(f"{BLUE}Node {self.node_id} sent its public key to peer {peer_port}{RESET}")
-        except Exception as e:
-            print(f"{RED}Node {self.node_id} failed to connect to peer {peer_port}: {e}{RESET}")
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass # skip the headers
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render().encode("utf-8")
+            else: status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        finally: writer.close()
+
+    async def handle_message(self, reader, writer, dialed=None):
+        """receive the public key and then the messages of a connected node; the connection of a replica,
+        dialed by us (dialed is its (host, port)) or by it, carries our messages to it as well."""
+        peer_id = None; peer_port = dialed[1] if dialed else None
+        try:
+            async for messages in self.receive_frames(reader):
+                if peer_id is None:
+                    handshake = messages.pop(0)
+                    try: peer_id = self.accept_handshake(handshake, writer, dialed)
+                    except Exception as e: raise ValueError(f"an invalid handshake: {e!r}") from e
+                    if not dialed and not handshake.fields.get("client"): peer_port = self.base_port + peer_id
+                # a node only speaks for itself: a message that names another replica as its sender is dropped
+                messages = [message for message in messages if self.sent_by(message, peer_id)]
+                if not messages: continue
+                # all the signatures delivered by one read are verified as one batch
+                try: verified = await self.verify_messages(messages, peer_id)
+                except Exception:
+                    logger.exception(f"{RED}Node %s failed to verify %s messages of node %s{RESET}", self.node_id, len(messages), peer_id)
+                    continue
+                for message, valid_signature in zip(messages, verified):
+                    self.metrics.inc("pbft_messages_received_total", (("phase", message.phase),))
+                    logger.debug("Node %s received message: %s", self.node_id, message)
+                    # process each message based on its type and the state of the protocol; a message that
+                    # breaks its handler is dropped, and the connection goes on with the next one
+                    try: await self.process_message(message, valid_signature)
+                    except Exception:
+                        logger.exception(f"{RED}Node %s failed to process a message of node %s: %s{RESET}", self.node_id, peer_id, message)
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"{RED}Node %s lost the connection of node %s: %s{RESET}", self.node_id, peer_id, e)
+        except ValueError as e: # an oversized or undecodable frame, or a bad handshake: the rest of the stream cannot be trusted
+            logger.warning(f"{RED}Node %s dropped the connection of node %s: %s{RESET}", self.node_id, peer_id, e)
+            writer.close()
+        # unless a newer connection to the peer replaced this one, the peer is disconnected until it is dialed again
+        outbox = self.peers.get(peer_port)
+        if outbox is not None and outbox.writer in (writer, None):
+            logger.warning(f"{RED}Node %s was disconnected from peer %s{RESET}", self.node_id, peer_port)
+            outbox.detach(writer)
+            if dialed: self.loop.create_task(self.redial_peer(*dialed))
+
+    def author(self, message):
+        """the replica a message claims to come from: the primary of its view for a PRE-PREPARE or NEW-VIEW,
+        otherwise the one named by its i (None for the messages that name no replica, a REQUEST or a CHUNK)."""
+        if message.phase in ("PRE-PREPARE", "NEW-VIEW"): return message.v % self.nodes_num if isinstance(message.v, int) else None
+        return message.i
+
+    def sent_by(self, message, peer_id):
+        """whether a message received over the connection of peer_id is one that peer_id may send; a client only sends requests."""
+        author = self.author(message)
+        if isinstance(peer_id, str): allowed = (message.phase == "REQUEST")
+        else: allowed = (author == peer_id or (author is None and message.phase in ("REQUEST", "CHUNK")))
+        if allowed: return True
+        self.metrics.inc("pbft_forged_messages_total")
+        logger.warning(f"{RED}Node %s dropped a %s message from node %s that claims to come from node %s{RESET}",
+                       self.node_id, message.phase, peer_id, author)
+        return False
 
-    def send_message(self, peer_port, json_message):
-        """send a message to a peer."""
+    def accept_handshake(self, handshake, writer, dialed):
+        """take the public key of a connected node and answer with ours; the id of the node is returned."""
+        peer_id = self.receive_public_key(handshake)
+        if handshake.fields.get("client"):
+            # a client only connects to the replicas, so its replies go back over this connection
+            self.clients[peer_id] = writer
+            writer.write(encode_frame(self.get_handshake()))
+        elif not dialed:
+            peer_port = self.base_port + peer_id
+            self.peer_queue(peer_port).attach(writer, encode_frame(self.get_handshake()))
+            logger.info("Node %s accepted the connection of peer %s", self.node_id, peer_port)
+        return peer_id
+
+    def peer_queue(self, peer_port):
+        """the outbound queue of a peer replica, created the first time it is needed."""
+        outbox = self.peers.get(peer_port)
+        if outbox is None: outbox = self.peers[peer_port] = PeerQueue(self.loop, outbound_queue_size, logger.warning)
+        return outbox
+
+    async def connect_to_peer(self, peer_host, peer_port):
+        """set up the connection to a peer node: of each pair, the replica with the lower id dials the other."""
+        self.peer_queue(peer_port)
+        if peer_port - self.base_port < self.node_id:
+            logger.debug("Node %s waits for peer %s to connect", self.node_id, peer_port); return
+        if not await self.dial_peer(peer_host, peer_port): self.loop.create_task(self.redial_peer(peer_host, peer_port))
+
+    async def dial_peer(self, peer_host, peer_port):
+        """connect to a peer node, send the public key and start reading the peer's messages."""
         try:
-            self.peers[peer_port].sendall(json.dumps(json_message).encode('utf-8'))
-            print(f"{BLUE}Node {self.node_id} sent message to peer {peer_port}: {json_message}{RESET}")
+            reader, writer = await self.open_connection(peer_host, peer_port)
         except Exception as e:
-            print(f"{RED}Failed to send message to peer {peer_port}: {e}{RESET}")                    
+            logger.warning(f"{RED}Node %s failed to connect to peer %s: %s{RESET}", self.node_id, peer_port, e)
+            return False
+        self.peer_queue(peer_port).attach(writer, encode_frame(self.get_handshake()))
+        logger.info("Node %s connected to peer %s", self.node_id, peer_port)
+        self.loop.create_task(self.handle_message(reader, writer, (peer_host, peer_port)))
+        return True
+
+    async def redial_peer(self, peer_host, peer_port):
+        """dial a peer again until it answers, waiting twice as long after every failure."""
+        delay = reconnect_delay
+        while True:
+            await asyncio.sleep(delay)
+            self.metrics.inc("pbft_reconnects_total", (("peer", peer_port),))
+            if await self.dial_peer(peer_host, peer_port): return
+            delay = min(2 * delay, reconnect_max_delay)
+
+    def send_message(self, peer_port, message):
+        """send a message to a peer once the records it depends on are in the write-ahead log."""
+        if self.wal: self.wal.after_sync(self.write_message, peer_port, message)
+        else: self.write_message(peer_port, message)
+
+    def broadcast_message(self, message):
+        """send a message to all peers: it is encoded once and queued for each of them, without waiting for any."""
+        if self.wal: self.wal.after_sync(self.write_broadcast, message)
+        else: self.write_broadcast(message)
+
+    def write_message(self, peer_port, message):
+        self.queue_frame(peer_port, message, encode_frame(message))
+
+    def write_broadcast(self, message):
+        frame = encode_frame(message)
+        for peer_port in list(self.peers): self.queue_frame(peer_port, message, frame)
+
+    def queue_frame(self, peer_port, message, frame):
+        """hand a frame to the outbound queue of a peer, whose writer task sends it."""
+        outbox = self.peers.get(peer_port)
+        if outbox is None:
+            logger.warning(f"{RED}Failed to send message to peer %s: not connected{RESET}", peer_port); return
+        if not outbox.put(frame):
+            logger.debug(f"{RED}The outbound queue of peer %s is full: dropped %s{RESET}", peer_port, message); return
+        self.metrics.inc("pbft_messages_sent_total", (("phase", message.phase),))
+        self.metrics.inc("pbft_bytes_sent_total", (("phase", message.phase),), len(frame))
+        logger.debug(f"{BLUE}Node %s sent message to peer %s: %s{RESET}", self.node_id, peer_port, message)
     
-    def get_digest(self, json_message):
-        """get the message digest produced by collision-resistant hash function"""
-        string_message = json.dumps(json_message)
-        input_bytes = string_message.encode('utf-8')
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(input_bytes)
-        return sha256_hash.hexdigest()
-
-    def broadcast_preprepare_message(self, vi):
-        """broadcast the pre-prepare message to all peers."""
-        print(f"{GREEN}Node {self.node_id} is going to broadcast PRE-PREPARE message{RESET}")
-        global seq_no; seq_no = seq_no + 1
-        json_request1 = {"phase": "REQUEST", "message": vi}
-        self.message_log.append(json_request1)
-        string_request1 = json.dumps(json_request1)
-
-        json_message1 = {"phase": "PRE-PREPARE", "v": self.view, "n": seq_no, "d": self.get_digest(json_request1)}
-        self.message_log.append(json_message1)
-        string_message1 = json.dumps(json_message1)
-        signed_message1 = self.sign_message(string_message1)
-
-        json_request2 = {"phase": "REQUEST", "message": vi+1}
-        string_request2 = json.dumps(json_request2)
-
-        json_message2 = {"phase": "PRE-PREPARE", "v": self.view, "n": seq_no, "d": self.get_digest(json_request2)}
-        string_message2 = json.dumps(json_message2)
-        signed_message2 = self.sign_message(string_message2)
+    def receive_request(self, message):
+        """order a client request, answer a retransmission from the reply cache, or relay it to the primary."""
+        json_request = message.fields
+        c, t = json_request["c"], json_request["t"]
+        if json_request.get("ro"):
+            self.answer_read(c, t); return
+        if self.executed_request(c, t):
+            # the request was already executed, so it is answered without running consensus again
+            reply = self.last_replies[c].get(t)
+            if reply: self.send_reply(c, reply)
+            return
+        primary = self.view % self.nodes_num
+        if primary == self.node_id and self.view_active:
+            if (c, t) in self.submitted_requests: return # already being ordered
+            self.submitted_requests.add((c, t))
+        if primary == self.node_id:
+            # the batch carries the request as the client signed it, so the backups can check that the primary did not forge it
+            if self.view_active: self.submit_operation(message.to_json())
+            return
+        # a backup relays the request and suspects the primary if it is not executed in time
+        self.send_message(self.base_port + primary, message)
+        if (c, t) not in self.request_timers:
+            self.request_timers[(c, t)] = self.set_timeout(self.current_timeout(), self.ignore_client_request, c, t)
+
+    def ignore_client_request(self, c, t):
+        """the relayed request t of client c was not executed in time: suspect the primary."""
+        if self.request_timers.pop((c, t), None) is None: return
+        self.metrics.inc("pbft_timer_expirations_total", (("timer", "client_request"),))
+        logger.info(f"{RED}Timeout: Request %s of client %s has not been executed in time!{RESET}", t, c)
+        self.resend_checkpoint()
+        self.start_view_change(self.view + 1)
+
+    def answer_read(self, c, t):
+        """answer the read-only request t of client c right away with the state executed so far, without
+        ordering it; the reply is not cached, since the client orders the read again if the replies disagree."""
+        self.metrics.inc("pbft_fast_reads_total")
+        fields = {"phase": "REPLY", "v": self.view, "t": t, "c": c, "i": self.node_id, "r": self.state}
+        self.send_reply(c, self.sign_message(fields))
+
+    def send_reply(self, c, message):
+        """send a signed REPLY to client c, once its execution is logged, if it is connected to this replica."""
+        if self.wal: self.wal.after_sync(self.write_reply, c, message)
+        else: self.write_reply(c, message)
+
+    def write_reply(self, c, message):
+        try:
+            if c in self.clients:
+                self.clients[c].write(encode_frame(message))
+                self.metrics.inc("pbft_messages_sent_total", (("phase", "REPLY"),))
+        except Exception as e:
+            logger.warning(f"{RED}Failed to send reply to client %s: %s{RESET}", c, e)
+
+    def submit_operation(self, vi):
+        """queue an operation until the primary's current batch is full or its time limit expires."""
+        self.pending_operations.append(vi)
+        if len(self.pending_operations) < batch_size:
+            if not self.batch_timer:
+                self.batch_timer = self.loop.call_later(batch_timeout, self.flush_batch)
+            return
+        batch, n = self.take_batch()
+        if batch: self.broadcast_preprepare_message(batch, n)
+
+    def flush_batch(self):
+        """order the pending operations, even a batch that is not full, as far as the window allows."""
+        while True:
+            batch, n = self.take_batch()
+            if not batch: return
+            self.broadcast_preprepare_message(batch, n)
+
+    def take_batch(self):
+        """remove the next batch and assign it a sequence number."""
+        if self.batch_timer:
+            self.batch_timer.cancel(); self.batch_timer = None
+        if not self.view_active or self.view % self.nodes_num != self.node_id:
+            return [], None # only the primary of an installed view orders batches
+        if not self.pending_operations or max(self.seq_no, self.last_executed) + 1 >= self.H:
+            return [], None # the batch waits until execution moves the window forward
+        self.seq_no = max(self.seq_no, self.last_executed) + 1
+        batch = self.pending_operations[:batch_size]
+        del self.pending_operations[:batch_size]
+        return batch, self.seq_no
+
+    def broadcast_preprepare_message(self, batch, seq_no):
+        """broadcast the pre-prepare message for a batch of operations to all peers."""
+        logger.debug(f"{GREEN}Node %s is going to broadcast PRE-PREPARE message for n = %s{RESET}", self.node_id, seq_no)
+        request1 = Message({"phase": "REQUEST", "message": batch})
+        self.log_message(request1)
+        message1 = self.sign_message({"phase": "PRE-PREPARE", "v": self.view, "n": seq_no, "d": request1.digest}, request1)
+        self.log_message(message1)
+        self.preprepare_messages[(self.view, seq_no)] = message1
+        self.observe_phase(seq_no, "pre-prepared")
+
+        # the malicious primary alters the operations, but it cannot sign them in the name of their clients
+        forged = [dict(request, m=canonical_encoding(dict(fields, o=fields["o"] + 1)).decode('utf-8')) if fields["o"] is not None else request
+                  for request, fields in ((request, json.loads(request["m"])) for request in batch)]
+        request2 = Message({"phase": "REQUEST", "message": forged})
+        message2 = self.sign_message({"phase": "PRE-PREPARE", "v": self.view, "n": seq_no, "d": request2.digest}, request2)
         
-        if self.node_id != 0:
-            for peer_port in self.peers:
-                self.send_message(peer_port, {"signed_message": signed_message1, "message": string_message1, "client_req": string_request1})
+        if self.node_id != malicious_primary: self.broadcast_message(message1)
         else:
             counter = 0
             for peer_port in self.peers:
-                if counter < max_faulty_nodes: self.send_message(peer_port, {"signed_message": signed_message1, "message": string_message1, "client_req": string_request1})
-                else: self.send_message(peer_port, {"signed_message": signed_message2, "message": string_message2, "client_req": string_request2})
+                if counter < max_faulty_nodes: self.send_message(peer_port, message1)
+                else: self.send_message(peer_port, message2)
                 counter = counter + 1
-            print("equivocation is done!")
-
-        self.timer = threading.Timer(timeout, self.ignore_request, args=())
-        self.timer.start() 
-        print(f"Timer start to work with timeout {timeout} seconds!")
-        # run a thread to continuously check whether prepared(m, v, n, i) is true
-        threading.Thread(target=self.check_for_commit, 
-            args=(json_request1, json_message1["v"], json_message1["n"])).start()
-        # run a thread to continuously check whether commited-local(m, v, n, i) is true
-        threading.Thread(target=self.check_for_execution, 
-            args=(json_request1, json_message1["v"], json_message1["n"])).start()
+            logger.info("equivocation is done!")
+
+        self.start_timer(seq_no)
+        self.check_for_commit(message1.v, message1.n, message1.d)
     
     def broadcast_prepare_message(self, preprepare_msg):
         """broadcast the prepare message to all peers."""
-        print(f"{GREEN}Node {self.node_id} is going to broadcast PREPARE message{RESET}")
-        json_request = json.loads(preprepare_msg["client_req"])
-        self.message_log.append(json_request)
-        json_preprepare_msg = json.loads(preprepare_msg["message"])
-        self.message_log.append(json_preprepare_msg)
-        json_message = {"phase": "PREPARE", "v": json_preprepare_msg["v"],
-                        "n": json_preprepare_msg["n"], "d": json_preprepare_msg["d"], "i": self.node_id}
-        string_message = json.dumps(json_message)
-        signed_message = self.sign_message(string_message)
-        self.message_log.append(json_message)
-        for peer_port in self.peers:
-            self.send_message(peer_port, {"signed_message": signed_message, "message": string_message})
+        logger.debug(f"{GREEN}Node %s is going to broadcast PREPARE message{RESET}", self.node_id)
+        self.log_message(preprepare_msg.request)
+        self.log_message(preprepare_msg)
+        self.preprepare_messages[(preprepare_msg.v, preprepare_msg.n)] = preprepare_msg
+        self.observe_phase(preprepare_msg.n, "pre-prepared")
+        # a PREPARE is always signed, since it may later prove in a VIEW-CHANGE that the request was prepared
+        message = self.sign_message({"phase": "PREPARE", "v": preprepare_msg.v,
+                                     "n": preprepare_msg.n, "d": preprepare_msg.d, "i": self.node_id})
+        self.log_message(message)
+        if collector_mode: self.send_message(self.base_port + self.collector(message.v), message)
+        else: self.broadcast_message(message)
             
     def broadcast_commit_message(self, v, n, d):
         """broadcast the commit message to all peers."""
-        print(f"{GREEN}Node {self.node_id} is going to broadcast COMMIT message{RESET}")
-        json_message = {"phase": "COMMIT", "v": v, "n": n, "d": d, "i": self.node_id}
-        string_message = json.dumps(json_message)
-        signed_message = self.sign_message(string_message)
-        self.message_log.append(json_message)
-        for peer_port in self.peers:
-            self.send_message(peer_port, {"signed_message": signed_message, "message": string_message}) 
-
-    def check_for_commit(self, m, v, n):
-        d = self.get_digest(m)
-        json_message = {"phase": "PRE-PREPARE", "v": v, "n": n, "d": d}
-        while self.timer:
-            t = self.count_logs(v, n, d, "PREPARE")
-            predicate = (m in self.message_log and json_message in self.message_log and t >= 2 * max_faulty_nodes)
-            print(f"prepared(m, {v}, {n}, {self.node_id}) = {predicate}")
-            time.sleep(0.5)
-            if predicate: 
-                self.broadcast_commit_message(v, n, d)
-                break
-
-    def check_for_execution(self, m, v, n):            
-        d = self.get_digest(m)
-        json_message = {"phase": "PRE-PREPARE", "v": v, "n": n, "d": d}
-        while self.timer:
-            t1 = self.count_logs(v, n, d, "PREPARE")
-            t2 = self.count_logs(v, n, d,  "COMMIT")
-            predicate = (m in self.message_log and json_message in self.message_log 
-                            and t1 >= 2 * max_faulty_nodes and t2 >= (2 * max_faulty_nodes + 1))
-            print(f"committed-local(m, {v}, {n}, {self.node_id}) = {predicate}")
-            time.sleep(0.5)
-            if predicate: 
-                print(f"{RED}Hey! Node {self.node_id} successfully executed the operation!{RESET}") 
-                self.state += str(m["message"])
-                self.timer.cancel()
-                print(f"{RED}The current state of node {self.node_id} is {self.state}!{RESET}")
-                break
+        logger.debug(f"{GREEN}Node %s is going to broadcast COMMIT message{RESET}", self.node_id)
+        message = self.authenticate({"phase": "COMMIT", "v": v, "n": n, "d": d, "i": self.node_id})
+        self.log_message(message)
+        if collector_mode:
+            if self.collector(v) != self.node_id: self.send_message(self.base_port + self.collector(v), message)
+        else: self.broadcast_message(message)
+
+    def collector(self, v):
+        """the replica that gathers the PREPAREs and COMMITs of view v in collector mode: its primary."""
+        return v % self.nodes_num
+
+    def broadcast_certificate(self, v, n, d, phase):
+        """as the collector, forward the quorum of PREPAREs (or COMMITs) logged for (v, n, d) to all peers as one message."""
+        logger.debug(f"{GREEN}Node %s is going to broadcast %s-CERTIFICATE message for n = %s{RESET}", self.node_id, phase, n)
+        votes = self.certificates.get((v, n, d, phase), {})
+        message = self.authenticate({"phase": f"{phase}-CERTIFICATE", "v": v, "n": n, "d": d, "i": self.node_id,
+                                     "Q": [vote.to_json() for vote in votes.values()]})
+        self.broadcast_message(message)
+
+    def authenticate(self, fields):
+        """encode a normal-case message and attach an authenticator, or a signature if authenticators are off;
+        in collector mode the votes are signed, since the collector passes them on to the other replicas."""
+        if not use_authenticators or collector_mode: return self.sign_message(fields)
+        message = Message(fields)
+        message.authenticator = self.authenticator(message.raw)
+        return message
+
+    def set_timeout(self, delay, callback, *args):
+        """run callback(*args) on the node's loop after delay seconds unless the returned timer is cancelled."""
+        if self.timer_wheel is None: self.timer_wheel = TimerWheel(self.loop, timer_tick, timer_slots)
+        return self.timer_wheel.call_later(delay, callback, *args)
+
+    def current_timeout(self):
+        """the timeout of requests and view changes: timeout until a latency is measured, then the average latency
+        plus timeout_deviations mean deviations, doubled for each consecutive view change, within the bounds."""
+        if self.latency_average is None: base = timeout
+        else: base = self.latency_average + timeout_deviations * self.latency_deviation
+        return min(max(base, min_timeout) * 2 ** self.view_change_backoff, max_timeout)
+
+    def observe_latency(self, latency):
+        """fold the latency of a batch from PRE-PREPARE to execution into the average and deviation."""
+        if self.latency_average is None:
+            self.latency_average = latency; self.latency_deviation = latency / 2
+        else:
+            self.latency_deviation += latency_deviation_gain * (abs(latency - self.latency_average) - self.latency_deviation)
+            self.latency_average += latency_gain * (latency - self.latency_average)
+
+    def start_timer(self, n):
+        """start the timer that gives up on sequence number n if it is not executed in time."""
+        if n in self.timers or n <= self.last_executed: return
+        delay = self.current_timeout()
+        self.timers[n] = self.set_timeout(delay, self.ignore_request, n)
+        self.timer_starts[n] = self.loop.time()
+        logger.debug("Timer start to work with timeout %.3f seconds for n = %s!", delay, n)
+
+    def check_for_commit(self, v, n, d):
+        """broadcast the COMMIT message as soon as prepared(m, v, n, i) becomes true."""
+        predicate = (v == self.view and (v, n, d) not in self.commits_sent and self.prepared(v, n, d))
+        if predicate: self.commits_sent.add((v, n, d))
+        if predicate:
+            self.observe_phase(n, "prepared")
+            logger.debug("prepared(m, %s, %s, %s) = True", v, n, self.node_id)
+            if collector_mode and self.collector(v) == self.node_id: self.broadcast_certificate(v, n, d, "PREPARE")
+            self.broadcast_commit_message(v, n, d)
+        self.check_for_execution(v, n, d)
+
+    def check_for_execution(self, v, n, d):
+        """execute the request as soon as committed-local(m, v, n, i) becomes true."""
+        predicate = (v == self.view and (v, n, d) not in self.executed and self.committed_local(v, n, d))
+        if not predicate: return
+        self.executed.add((v, n, d))
+        self.observe_phase(n, "committed")
+        logger.debug("committed-local(m, %s, %s, %s) = True", v, n, self.node_id)
+        # a sequence number re-proposed after a view change may already be executed here
+        if n > self.last_executed: self.committed[n] = d
+        checkpoints = self.execute_in_order()
+        if collector_mode and self.collector(v) == self.node_id: self.broadcast_certificate(v, n, d, "COMMIT")
+        for n in checkpoints: self.broadcast_checkpoint_message(n)
+        if self.pending_operations: self.flush_batch()
+
+    def execute_in_order(self):
+        """execute committed batches in sequence order and return the new checkpoints."""
+        checkpoints = []
+        while self.last_executed + 1 in self.committed:
+            n = self.last_executed + 1
+            # the whole batch is executed within one step of the event loop, so no message sees it half done
+            batch = [request.fields for request in self.requests[self.committed.pop(n)].embedded("message")]
+            operations = []; replies = []
+            for request in batch:
+                if self.executed_request(request["c"], request["t"]): # a request is executed at most once
+                    self.submitted_requests.discard((request["c"], request["t"])); continue
+                # a read (o is None) is ordered like the other requests but leaves the state as it is
+                if request["o"] is not None:
+                    self.state += str(request["o"])
+                    operations.append(request["o"])
+                replies.append(self.reply(request))
+            # the operations and the replies of a batch go to the log as one record, so a crash keeps both or neither
+            if self.wal: self.wal.append({"type": "execute", "n": n, "o": operations, "r": [encode_message(message) for message in replies]})
+            for message in replies: self.send_reply(message.fields["c"], message)
+            self.last_executed = n
+            self.observe_phase(n, "executed")
+            if n in self.timers: self.timers.pop(n).cancel()
+            if n in self.timer_starts:
+                self.observe_latency(self.loop.time() - self.timer_starts.pop(n))
+                self.view_change_backoff = 0
+            logger.info(f"{RED}Hey! Node %s successfully executed a batch of %s operations for n = %s!{RESET}", self.node_id, len(batch), n)
+            logger.info(f"{RED}The current state of node %s is %s!{RESET}", self.node_id, self.state)
+            if n % checkpoint_interval == 0:
+                self.checkpoint_states[n] = (self.state, self.reply_timestamps())
+                checkpoints.append(n)
+        return checkpoints
+
+    def reply(self, request):
+        """sign the result of an executed request and cache it as the client's last reply; the caller sends it."""
+        c, t = request["c"], request["t"]
+        if (c, t) in self.request_timers: self.request_timers.pop((c, t)).cancel()
+        self.submitted_requests.discard((c, t))
+        message = self.sign_message({"phase": "REPLY", "v": self.view, "t": t, "c": c, "i": self.node_id, "r": self.state})
+        self.cache_reply(c, t, message)
+        return message
+
+    def cache_reply(self, c, t, message):
+        """remember the reply to request t of client c, forgetting the oldest beyond the last client_window."""
+        replies = self.last_replies.setdefault(c, {})
+        replies[t] = message
+        while len(replies) > client_window: del replies[min(replies)]
+
+    def executed_request(self, c, t):
+        """whether request t of client c was executed: its reply is cached, or it is older than every cached one
+        while the cache is full, which a client that keeps to client_window outstanding requests never retransmits."""
+        replies = self.last_replies.get(c)
+        return bool(replies) and (t in replies or (len(replies) >= client_window and t < min(replies)))
+
+    def reply_timestamps(self):
+        """the timestamps of the last requests executed for each client, which are part of the checkpointed state."""
+        return {c: sorted(replies) for c, replies in self.last_replies.items()}
+
+    def adopt_reply_timestamps(self, timestamps):
+        """take the executed requests of a checkpointed state, keeping the replies we cached for them."""
+        self.last_replies = {c: {t: self.last_replies.get(c, {}).get(t) for t in replies} for c, replies in timestamps.items()}
+
+    def state_chunk_digests(self, state):
+        """the digests of the state_chunk_size chunks of a state of this replica (the current one or a checkpointed one)."""
+        complete = len(state) // state_chunk_size
+        for index in range(len(self.chunk_digests), complete):
+            self.chunk_digests.append(hashlib.sha256(state[index * state_chunk_size:(index + 1) * state_chunk_size].encode('utf-8')).hexdigest())
+        digests = self.chunk_digests[:complete]
+        if len(state) % state_chunk_size: digests.append(hashlib.sha256(state[complete * state_chunk_size:].encode('utf-8')).hexdigest())
+        return digests
+
+    def get_state_digest(self, state, replies, chunk_digests=None):
+        """digest of the replicated state, as carried by CHECKPOINT messages: it covers the digest of every
+        chunk of the state, so each chunk fetched during a state transfer can be checked on its own."""
+        if chunk_digests is None: chunk_digests = self.state_chunk_digests(state)
+        return hashlib.sha256(canonical_encoding({"chunks": chunk_digests, "replies": replies})).hexdigest()
+
+    def broadcast_checkpoint_message(self, n):
+        """broadcast a signed checkpoint of the state after executing sequence number n, naming our view."""
+        message = self.sign_message({"phase": "CHECKPOINT", "n": n, "d": self.get_state_digest(*self.checkpoint_states[n]),
+                                     "v": self.view, "i": self.node_id})
+        logger.debug(f"{GREEN}Node %s is going to broadcast CHECKPOINT message for n = %s{RESET}", self.node_id, n)
+        self.checkpoint_message = message
+        self.broadcast_message(message)
+        self.log_checkpoint(message)
+
+    def resend_checkpoint(self):
+        """broadcast our latest CHECKPOINT again: a lost one may keep the checkpoint from becoming stable, and a
+        primary whose window is full from ordering anything."""
+        if self.checkpoint_message is None: return
+        logger.debug(f"{GREEN}Node %s resends its CHECKPOINT message for n = %s{RESET}", self.node_id, self.checkpoint_message.n)
+        self.broadcast_message(self.checkpoint_message)
+
+    def log_checkpoint(self, message):
+        """record a CHECKPOINT message and make the checkpoint stable once 2f + 1 of them match ours."""
+        n, d = message.n, message.d
+        if n <= self.h: return # our own CHECKPOINT of a checkpoint that is already stable
+        # a replica has one CHECKPOINT per sequence number; beyond the next window, only its latest one is kept
+        far = n > self.H + (self.H - self.h)
+        for (m, digest), signers in list(self.checkpoints.items()):
+            if message.i not in signers or (m != n and not (far and m > self.H + (self.H - self.h))): continue
+            if m >= n: return
+            del signers[message.i]
+            if not signers: del self.checkpoints[(m, digest)]
+        proof = self.checkpoints.setdefault((n, d), {})
+        proof[message.i] = message
+        if (len(proof) >= 2 * max_faulty_nodes + 1 and n > self.h and n in self.checkpoint_states
+            and self.get_state_digest(*self.checkpoint_states[n]) == d):
+            self.collect_garbage(n, d, proof)
+        elif len(proof) >= 2 * max_faulty_nodes + 1 and n > self.last_executed:
+            # the checkpoint is stable at other replicas but this one has not executed up to it
+            if n >= self.H: self.request_state(n)
+            elif self.transfer is None and self.transfer_timer is None:
+                self.transfer_timer = self.set_timeout(state_transfer_delay, self.check_progress, n)
+
+    def collect_garbage(self, n, d, proof):
+        """make checkpoint n stable: advance the watermarks and discard everything logged up to n."""
+        self.stable_checkpoint = (n, d, dict(proof))
+        self.H = n + (self.H - self.h); self.h = n
+        self.message_log = [log for log in self.message_log if log.n is None or log.n > n]
+        self.preprepares = {key: digest for key, digest in self.preprepares.items() if key[1] > n}
+        self.preprepare_messages = {key: message for key, message in self.preprepare_messages.items() if key[1] > n}
+        self.certificates = {key: votes for key, votes in self.certificates.items() if key[1] > n}
+        self.commits_sent = {key for key in self.commits_sent if key[1] > n}
+        self.executed = {key for key in self.executed if key[1] > n}
+        live_digests = set(self.preprepares.values()) | set(self.committed.values())
+        self.requests = {digest: request for digest, request in self.requests.items() if digest in live_digests}
+        self.message_log = [log for log in self.message_log
+                            if log.phase != "REQUEST" or log.digest in live_digests]
+        self.checkpoints = {key: proof for key, proof in self.checkpoints.items() if key[0] > n}
+        self.checkpoint_states = {key: checkpoint for key, checkpoint in self.checkpoint_states.items() if key >= n}
+        self.phase_times = {key: phase_time for key, phase_time in self.phase_times.items() if key > n}
+        if self.wal:
+            self.wal.append({"type": "checkpoint", "n": n, "d": d, "C": [encode_message(message) for message in proof.values()]})
+            if n - self.last_snapshot >= snapshot_interval:
+                self.wal.snapshot(self.snapshot_fields()); self.last_snapshot = n
+        logger.info(f"{GREEN}Node %s has a stable checkpoint at n = %s; the watermarks are now (%s, %s){RESET}", self.node_id, n, self.h, self.H)
+        if self.pending_operations: self.flush_batch()
+
+    def check_progress(self, n):
+        """a checkpoint n was stable elsewhere state_transfer_delay seconds ago: fetch it if this replica is still behind."""
+        self.transfer_timer = None
+        if self.last_executed < n: self.request_state(n)
+
+    def request_state(self, n):
+        """ask every replica for its latest stable checkpoint at or above n, with the digests of its chunks."""
+        if self.transfer is not None: return
+        if self.transfer_timer: self.transfer_timer.cancel(); self.transfer_timer = None
+        self.transfer = {"n": n, "checkpoint": None, "chunks": {}, "missing": set(), "sources": [], "attempts": 0,
+                         "timer": self.set_timeout(state_transfer_timeout, self.state_transfer_timeout)}
+        self.transfer_started = self.loop.time()
+        logger.info(f"{RED}Node %s is behind (executed up to n = %s) and fetches the state of a checkpoint at or above n = %s{RESET}",
+                    self.node_id, self.last_executed, n)
+        message = Message({"phase": "STATE-REQUEST", "n": n, "i": self.node_id})
+        self.broadcast_message(message)
+
+    def send_manifest(self, message):
+        """answer a STATE-REQUEST with our stable checkpoint, its proof and the digests of its chunks."""
+        n, d, proof = self.stable_checkpoint
+        if n < message.n or n not in self.checkpoint_states or not proof: return
+        state, replies = self.checkpoint_states[n]
+        self.send_message(self.base_port + message.i, Message({"phase": "STATE-MANIFEST", "n": n, "d": d, "i": self.node_id,
+                                                               "C": [checkpoint.to_json() for checkpoint in proof.values()],
+                                                               "chunks": self.state_chunk_digests(state), "length": len(state),
+                                                               "replies": replies,
+                                                               "V": self.last_new_view.to_json() if self.last_new_view else None}))
+
+    def receive_manifest(self, message):
+        """adopt the first manifest of a checkpoint ahead of us that is proven stable and matches its digest."""
+        transfer = self.transfer
+        if transfer is None or transfer["checkpoint"] is not None or message.n < transfer["n"] or message.n <= self.last_executed: return
+        fields = message.fields
+        proof = message.embedded("C")
+        if (not self.valid_checkpoint_proof(message.n, proof) or any(checkpoint.d != message.d for checkpoint in proof)
+            or self.get_state_digest(None, fields["replies"], fields["chunks"]) != message.d): return
+        transfer["checkpoint"] = (message.n, message.d, {checkpoint.i: checkpoint for checkpoint in proof})
+        transfer["digests"] = fields["chunks"]; transfer["length"] = fields["length"]; transfer["replies"] = fields["replies"]
+        transfer["new_view"] = Message.from_json(fields["V"]) if fields["V"] else None
+        transfer["view"] = self.attested_view(proof)
+        # the chunks of our own state that the checkpoint shares are not fetched again
+        own_chunks = self.state_chunk_digests(self.state)
+        for index, digest in enumerate(transfer["digests"]):
+            if index < len(own_chunks) and own_chunks[index] == digest:
+                transfer["chunks"][index] = self.state[index * state_chunk_size:(index + 1) * state_chunk_size]
+            else: transfer["missing"].add(index)
+        transfer["fetched"] = len(transfer["missing"])
+        # any replica that signed the checkpoint can serve its chunks
+        transfer["sources"] = [replica for replica in transfer["checkpoint"][2] if replica != self.node_id]
+        self.request_chunks()
+
+    def attested_view(self, proof):
+        """the highest view that f + 1 signers of a checkpoint proof had reached, so at least one correct replica did."""
+        views = sorted((checkpoint.v if isinstance(checkpoint.v, int) else 0 for checkpoint in proof), reverse=True)
+        return views[max_faulty_nodes]
+
+    def request_chunks(self):
+        """spread the missing chunks over the sources, so that they are fetched in parallel."""
+        transfer = self.transfer
+        if not transfer["missing"]: return self.install_state()
+        sources = transfer["sources"]
+        offset = transfer["attempts"] # a retry asks each chunk from another replica
+        requests = {}
+        for position, index in enumerate(sorted(transfer["missing"])):
+            requests.setdefault(sources[(position + offset) % len(sources)], []).append(index)
+        for replica, indexes in requests.items():
+            self.send_message(self.base_port + replica, Message({"phase": "CHUNK-REQUEST", "n": transfer["checkpoint"][0],
+                                                                "chunks": indexes, "i": self.node_id}))
+        transfer["timer"].cancel()
+        transfer["timer"] = self.set_timeout(state_transfer_timeout, self.state_transfer_timeout)
+
+    def send_chunks(self, message):
+        """send the requested chunks of a checkpointed state, if we still keep it."""
+        if message.n not in self.checkpoint_states: return
+        state = self.checkpoint_states[message.n][0]
+        for index in message.fields["chunks"]:
+            self.send_message(self.base_port + message.i, Message({"phase": "CHUNK", "n": message.n, "index": index,
+                                                                   "data": state[index * state_chunk_size:(index + 1) * state_chunk_size]}))
+
+    def receive_chunk(self, message):
+        """keep a chunk of the checkpoint being fetched if it matches its digest, and install the state once complete."""
+        transfer = self.transfer
+        if transfer is None or transfer["checkpoint"] is None or message.n != transfer["checkpoint"][0]: return
+        index = message.fields["index"]
+        if index not in transfer["missing"]: return
+        data = message.fields["data"]
+        if hashlib.sha256(data.encode('utf-8')).hexdigest() != transfer["digests"][index]: return
+        transfer["chunks"][index] = data
+        transfer["missing"].discard(index)
+        if not transfer["missing"]: self.install_state()
+
+    def state_transfer_timeout(self):
+        """ask for the chunks still missing from other replicas, or start over when no manifest arrived."""
+        transfer = self.transfer
+        if transfer is None: return
+        transfer["attempts"] += 1
+        if transfer["checkpoint"] is None:
+            self.transfer = None # no replica has a stable checkpoint that far yet; a later one starts over
+        elif transfer["attempts"] > len(transfer["sources"]):
+            # the sources may have discarded the checkpoint for a newer one in the meantime
+            self.transfer = None
+            self.request_state(max(transfer["n"], self.last_executed + 1))
+        else: self.request_chunks()
+
+    def install_state(self):
+        """adopt the fetched state of a stable checkpoint and resume the protocol from it."""
+        transfer = self.transfer
+        self.transfer = None
+        transfer["timer"].cancel()
+        n, d, proof = transfer["checkpoint"]
+        if n <= self.last_executed: return
+        state = "".join(transfer["chunks"][index] for index in range(len(transfer["digests"])))
+        self.state = state; self.chunk_digests = []
+        self.last_executed = n; self.seq_no = max(self.seq_no, n)
+        self.adopt_reply_timestamps(transfer["replies"])
+        self.checkpoint_states[n] = (state, transfer["replies"])
+        self.committed = {key: digest for key, digest in self.committed.items() if key > n}
+        for key in [key for key in self.timers if key <= n]: self.timers.pop(key).cancel()
+        self.timer_starts = {key: started for key, started in self.timer_starts.items() if key > n}
+        if self.wal: self.wal.append({"type": "state", "n": n, "state": state, "replies": transfer["replies"]})
+        # batches committed above the checkpoint while the state was fetched run right away
+        checkpoints = self.execute_in_order()
+        self.collect_garbage(n, d, proof)
+        # the replicas that are still missing this checkpoint learn that we have it too
+        self.broadcast_checkpoint_message(n)
+        for m in checkpoints: self.broadcast_checkpoint_message(m)
+        self.metrics.inc("pbft_state_transfers_total")
+        self.metrics.observe("pbft_state_transfer_seconds", self.loop.time() - self.transfer_started)
+        logger.info(f"{RED}Node %s installed the state of stable checkpoint n = %s in %.3f seconds, fetching %s of its %s chunks{RESET}",
+                    self.node_id, n, self.loop.time() - self.transfer_started, transfer["fetched"], len(transfer["digests"]))
+        # a replica that missed a view change catches up with it too, once the NEW-VIEW checks out; one that was cut off
+        # may have suspected its way into views that never formed, and falls back to the one the checkpoint's signers
+        # are running: to the view of the NEW-VIEW, or to view 0, which needs none
+        new_view, view = transfer["new_view"], transfer["view"]
+        if new_view is not None and new_view.v >= view and not (new_view.v <= self.view and self.view_active):
+            previous, self.view = self.view, min(self.view, new_view.v)
+            if self.accept_new_view_message(new_view, True):
+                self.last_new_view = new_view
+                self.install_new_view(new_view.v, self.proven_checkpoint(new_view.embedded("V")),
+                                      [preprepare for preprepare in new_view.embedded("O") if preprepare.n > n])
+                self.forget_view_changes(new_view.v)
+            else: self.view = previous
+        elif view == 0 and not self.view_active:
+            self.view = 0; self.view_active = True
+            if self.new_view_timer: self.new_view_timer.cancel(); self.new_view_timer = None
+            if self.wal: self.wal.append({"type": "view", "v": 0, "active": True})
+            self.forget_view_changes(0)
+            logger.info(f"{RED}Node %s moved back to view 0{RESET}", self.node_id)
+        # instances above the checkpoint that were already agreed on can now execute
+        for (v, m), digest in list(self.preprepares.items()):
+            if v == self.view and m > n: self.check_for_commit(v, m, digest)
+
+    def forget_view_changes(self, v):
+        """after rejoining view v, drop our suspicions of the views that never formed and restart the timeouts afresh."""
+        self.view_change_started = None; self.view_change_backoff = 0
+        view_changes = {view: {i: message for i, message in messages.items() if i != self.node_id}
+                        for view, messages in self.view_changes.items() if view > v}
+        self.view_changes = {view: messages for view, messages in view_changes.items() if messages}
+
+    def snapshot_fields(self):
+        """everything a restarted replica needs besides the log records appended after this moment."""
+        n, d, proof = self.stable_checkpoint
+        return {"state": self.state, "view": self.view, "view_active": self.view_active, "seq_no": self.seq_no,
+                "last_executed": self.last_executed, "h": self.h, "H": self.H,
+                "stable_checkpoint": [n, d, [encode_message(message) for message in proof.values()]],
+                "checkpoint_states": {str(key): list(checkpoint) for key, checkpoint in self.checkpoint_states.items()},
+                "last_replies": {c: [[t, encode_message(message) if message else None] for t, message in replies.items()]
+                                 for c, replies in self.last_replies.items()},
+                "message_log": [encode_message(message) for message in self.message_log]}
+
+    def recover(self):
+        """load the latest snapshot and replay the write-ahead log after it, then keep logging."""
+        wal = WriteAheadLog(wal_dir, f"node-{self.node_id}", self.loop, logger.error)
+        start = time.perf_counter()
+        snapshot, records = wal.load()
+        if snapshot:
+            self.state = snapshot["state"]
+            self.view, self.view_active = snapshot["view"], snapshot["view_active"]
+            self.seq_no, self.last_executed = snapshot["seq_no"], snapshot["last_executed"]
+            self.h, self.H = snapshot["h"], snapshot["H"]
+            n, d, proof = snapshot["stable_checkpoint"]
+            proof = [decode_message(message) for message in proof]
+            self.stable_checkpoint = (n, d, {message.i: message for message in proof})
+            self.last_snapshot = n
+            self.checkpoint_states = {int(key): tuple(checkpoint) for key, checkpoint in snapshot["checkpoint_states"].items()}
+            self.last_replies = {c: {t: decode_message(message) if message else None for t, message in replies}
+                                 for c, replies in snapshot["last_replies"].items()}
+            for message in snapshot["message_log"]: self.replay_message(decode_message(message))
+        for record in records:
+            kind = record["type"]
+            if kind == "message": self.replay_message(decode_message(record["m"]))
+            elif kind == "execute":
+                self.state += "".join(str(operation) for operation in record["o"])
+                self.last_executed = record["n"]
+                for message in map(decode_message, record["r"]): self.cache_reply(message.fields["c"], message.fields["t"], message)
+                if self.last_executed % checkpoint_interval == 0:
+                    self.checkpoint_states[self.last_executed] = (self.state, self.reply_timestamps())
+            elif kind == "view":
+                self.view, self.view_active = record["v"], record["active"]
+                if not self.view_active: self.phase_times = {}
+            elif kind == "state":
+                self.state, self.last_executed, self.chunk_digests = record["state"], record["n"], []
+                self.adopt_reply_timestamps(record["replies"])
+                self.checkpoint_states[record["n"]] = (record["state"], record["replies"])
+            elif kind == "checkpoint":
+                proof = [decode_message(message) for message in record["C"]]
+                self.collect_garbage(record["n"], record["d"], {message.i: message for message in proof})
+        self.seq_no = max(self.seq_no, self.last_executed)
+        self.wal = wal
+        logger.info(f"{GREEN}Node %s recovered view %s and its state up to n = %s from its snapshot and %s log records in %.3f seconds{RESET}",
+                    self.node_id, self.view, self.last_executed, len(records), time.perf_counter() - start)
+        # the instances that were in flight resume; a view change that was in progress restarts its timer
+        for (v, n), d in list(self.preprepares.items()):
+            if v == self.view and n > self.last_executed:
+                self.start_timer(n)
+                self.check_for_commit(v, n, d)
+        if not self.view_active: self.new_view_timer = self.set_timeout(self.current_timeout(), self.new_view_timeout, self.view)
+
+    def replay_message(self, message):
+        """log a message again as it was logged before the restart, with the state derived from it."""
+        self.log_message(message)
+        if message.phase == "PRE-PREPARE":
+            self.preprepare_messages[(message.v, message.n)] = message
+            if message.v % self.nodes_num == self.node_id: self.seq_no = max(self.seq_no, message.n)
+        elif message.phase == "COMMIT" and message.i == self.node_id:
+            self.commits_sent.add((message.v, message.n, message.d))
+
+    def log_message(self, message):
+        """append a message to the log and index it for the quorum checks."""
+        if self.wal: self.wal.append({"type": "message", "m": encode_message(message)})
+        self.message_log.append(message)
+        phase = message.phase
+        if phase == "REQUEST":
+            self.requests[message.digest] = message
+        elif phase == "PRE-PREPARE":
+            self.preprepares[(message.v, message.n)] = message.d
+        else:
+            key = (message.v, message.n, message.d, phase)
+            self.certificates.setdefault(key, {})[message.i] = message
 
     def count_logs(self, v, n, d, phase):
-        count = 0
-        for log in self.message_log:
-            if (log["phase"] == phase and log["v"] == v 
-                and log["n"] == n and log["d"] == d):
-                count = count + 1
-        return count
+        """number of distinct replicas whose message of this phase is logged for (v, n, d)."""
+        return len(self.certificates.get((v, n, d, phase), ()))
+
+    def prepared(self, v, n, d):
+        """prepared(m, v, n, i): the request, its PRE-PREPARE and 2f matching PREPAREs are logged."""
+        return (d in self.requests and self.preprepares.get((v, n)) == d
+                and self.count_logs(v, n, d, "PREPARE") >= 2 * max_faulty_nodes)
+
+    def committed_local(self, v, n, d):
+        """committed-local(m, v, n, i): prepared and 2f + 1 matching COMMITs are logged."""
+        return self.prepared(v, n, d) and self.count_logs(v, n, d, "COMMIT") >= 2 * max_faulty_nodes + 1
     
-    def ignore_request(self):
-        self.timer = None
-        print(f"{RED}Timeout: Operation has not been executed after {timeout} seconds!{RESET}")
-        self.view = self.view + 1
-        print(f"{RED}The current state of node {self.node_id} is {self.state}!{RESET}")
+    def ignore_request(self, n):
+        """the request with sequence number n was not executed in time: suspect the primary."""
+        if n not in self.timers: return
+        self.resend_checkpoint()
+        if self.transfer is not None or self.transfer_timer is not None:
+            # a later checkpoint is stable at 2f + 1 replicas, so the primary makes progress and we are the one behind
+            self.timers.pop(n)
+            self.start_timer(n)
+            return
+        self.metrics.inc("pbft_timer_expirations_total", (("timer", "request"),))
+        logger.info(f"{RED}Timeout: Operation has not been executed in time for n = %s!{RESET}", n)
+        logger.info(f"{RED}The current state of node %s is %s!{RESET}", self.node_id, self.state)
+        self.start_view_change(self.view + 1)
+
+    def start_view_change(self, new_view):
+        """stop accepting normal-case messages and broadcast a VIEW-CHANGE message for new_view."""
+        if new_view <= self.view: return
+        # instances in flight are abandoned; prepared ones are carried into the new view
+        for timer in list(self.timers.values()) + list(self.request_timers.values()): timer.cancel()
+        self.timers = {}; self.committed = {}; self.request_timers = {}; self.submitted_requests = set()
+        self.timer_starts = {}
+        self.view = new_view; self.view_active = False
+        if self.view_change_started is None: self.view_change_started = self.loop.time()
+        if self.new_view_timer: self.new_view_timer.cancel()
+        # if the new primary does not install the view in time, move on to the next one; every view
+        # change that follows before a batch executes waits twice as long
+        self.new_view_timer = self.set_timeout(self.current_timeout(), self.new_view_timeout, new_view)
+        self.view_change_backoff += 1
+        self.phase_times = {}
+        if self.wal: self.wal.append({"type": "view", "v": new_view, "active": False})
+        self.metrics.inc("pbft_view_changes_total")
+        preprepares, prepares = self.prepared_certificates()
+        message = self.sign_message({"phase": "VIEW-CHANGE", "v": new_view, "n": self.stable_checkpoint[0],
+                                     "C": [checkpoint.to_json() for checkpoint in self.stable_checkpoint[2].values()],
+                                     "P": preprepares, "Q": prepares, "i": self.node_id})
+        logger.info(f"{GREEN}Node %s is going to broadcast VIEW-CHANGE message for view %s{RESET}", self.node_id, new_view)
+        self.broadcast_message(message)
+        self.log_view_change(message)
+
+    def new_view_timeout(self, v):
+        """the primary of view v did not install it in time: move on to the next view."""
+        self.metrics.inc("pbft_timer_expirations_total", (("timer", "new_view"),))
+        self.start_view_change(v + 1)
 
-    def process_message(self, packet, public_key_pem):
+    def prepared_certificates(self):
+        """the P and Q sets of a VIEW-CHANGE: for every request prepared above the stable checkpoint,
+        the signed PRE-PREPARE with its request, and the signed PREPAREs that prepared it."""
+        preprepares = []; prepares = []
+        for (v, n), d in self.preprepares.items():
+            if n > self.h and (v, n) in self.preprepare_messages and self.prepared(v, n, d):
+                preprepares.append(self.preprepare_messages[(v, n)].to_json())
+                prepares.extend(vote.to_json() for vote in self.certificates[(v, n, d, "PREPARE")].values()
+                                if vote.signature is not None)
+        return preprepares, prepares
+
+    def log_view_change(self, message):
+        """record a VIEW-CHANGE; join a view change backed by f + 1 replicas and, as the new primary, install the view."""
+        v = message.v
+        # i is the replica that signed the message: sent_by bound it to the connection it came from. Only its latest
+        # VIEW-CHANGE counts, so a faulty replica cannot fill the log with one for every view
+        for view in [view for view, messages in self.view_changes.items() if message.i in messages]:
+            if view > v: return
+            del self.view_changes[view][message.i]
+            if not self.view_changes[view]: del self.view_changes[view]
+        self.view_changes.setdefault(v, {})[message.i] = message
+        senders = set()
+        for view, messages in self.view_changes.items():
+            if view > self.view: senders.update(messages)
+        if len(senders) >= max_faulty_nodes + 1:
+            # f + 1 replicas already suspect the primary, so at least one correct replica does too
+            self.start_view_change(min(view for view in self.view_changes if view > self.view))
+        if (v == self.view and not self.view_active and v % self.nodes_num == self.node_id
+            and len(self.view_changes[v]) >= 2 * max_faulty_nodes + 1):
+            self.broadcast_new_view_message(v)
+
+    def valid_checkpoint_proof(self, n, proof):
+        """check that 2f + 1 replicas signed the same CHECKPOINT for n."""
+        if n == h: return True
+        signers = set(); digests = set()
+        for message in proof:
+            if (message.phase == "CHECKPOINT" and message.n == n and
+                self.verify_message(self.public_keys.get(message.i), message)):
+                signers.add(message.i); digests.add(message.d)
+        return len(signers) >= 2 * max_faulty_nodes + 1 and len(digests) == 1
+
+    def valid_prepared_certificate(self, preprepare, prepares):
+        """check that an entry of P is a PRE-PREPARE signed by the primary of its view for the carried request,
+        backed by the matching PREPAREs of 2f other replicas."""
+        primary = preprepare.v % self.nodes_num
+        if not (preprepare.phase == "PRE-PREPARE" and preprepare.request is not None
+                and preprepare.request.digest == preprepare.d
+                and self.verify_message(self.public_keys.get(primary), preprepare)): return False
+        signers = set()
+        for vote in prepares.get((preprepare.v, preprepare.n, preprepare.d), ()):
+            if (vote.phase == "PREPARE" and vote.i != primary and vote.i not in signers
+                and self.verify_message(self.public_keys.get(vote.i), vote)):
+                signers.add(vote.i)
+        return len(signers) >= 2 * max_faulty_nodes
+
+    def proven_checkpoint(self, view_changes):
+        """the latest stable checkpoint that the VIEW-CHANGE messages prove: (min-s, digest, {i: CHECKPOINT})."""
+        checkpoint = (h, None, {})
+        for message in view_changes:
+            if message.n > checkpoint[0] and self.valid_checkpoint_proof(message.n, message.embedded("C")):
+                proof = {vote.i: vote for vote in message.embedded("C") if vote.n == message.n
+                         and self.verify_message(self.public_keys.get(vote.i), vote)}
+                checkpoint = (message.n, next(iter(proof.values())).d, proof)
+        return checkpoint
+
+    def compute_new_view(self, view_changes):
+        """pick, for every sequence number after the latest stable checkpoint, the request prepared in
+        the highest view, or a null request; returns min-s and {n: request}."""
+        min_s = self.proven_checkpoint(view_changes)[0]
+        chosen = {}
+        for message in view_changes:
+            prepares = {}
+            for vote in message.embedded("Q"): prepares.setdefault((vote.v, vote.n, vote.d), []).append(vote)
+            for preprepare in message.embedded("P"):
+                n = preprepare.n
+                if (n > min_s and (n not in chosen or preprepare.v > chosen[n].v)
+                    and self.valid_prepared_certificate(preprepare, prepares)):
+                    chosen[n] = preprepare
+        requests = {}
+        for n in range(min_s + 1, max(chosen, default=min_s) + 1):
+            if n in chosen: requests[n] = chosen[n].request
+            else: requests[n] = Message({"phase": "REQUEST", "message": []}) # null request
+        return min_s, requests
+
+    def broadcast_new_view_message(self, v):
+        """as the primary of view v, re-propose the pending sequence numbers and install the view."""
+        view_changes = list(self.view_changes[v].values())
+        min_s, requests = self.compute_new_view(view_changes)
+        preprepares = [self.sign_message({"phase": "PRE-PREPARE", "v": v, "n": n, "d": request.digest}, request)
+                       for n, request in requests.items()]
+        message = self.sign_message({"phase": "NEW-VIEW", "v": v, "V": [view_change.to_json() for view_change in view_changes],
+                                     "O": [preprepare.to_json() for preprepare in preprepares]})
+        logger.info(f"{GREEN}Node %s is going to broadcast NEW-VIEW message for view %s{RESET}", self.node_id, v)
+        self.last_new_view = message
+        self.broadcast_message(message)
+        self.install_new_view(v, self.proven_checkpoint(view_changes), preprepares)
+
+    def install_new_view(self, v, checkpoint, preprepares):
+        """enter view v from the stable checkpoint its VIEW-CHANGE messages prove and run the normal protocol
+        on the PRE-PREPAREs of the NEW-VIEW message."""
+        self.view = v; self.view_active = True
+        if self.new_view_timer: self.new_view_timer.cancel(); self.new_view_timer = None
+        failover = None
+        if self.view_change_started is not None:
+            failover = self.last_failover = self.loop.time() - self.view_change_started
+            self.view_change_started = None
+            self.metrics.observe("pbft_failover_seconds", self.last_failover)
+        self.view_changes = {view: messages for view, messages in self.view_changes.items() if view > v}
+        # the new view starts from min-s: a replica whose own checkpoint is not stable yet makes it stable,
+        # and one that has not executed that far fetches its state
+        min_s, d, proof = checkpoint
+        if min_s > self.h:
+            if min_s in self.checkpoint_states and self.get_state_digest(*self.checkpoint_states[min_s]) == d:
+                self.collect_garbage(min_s, d, proof)
+            elif min_s > self.last_executed: self.request_state(min_s)
+        self.seq_no = max([self.last_executed, min_s] + [preprepare.n for preprepare in preprepares])
+        if self.wal: self.wal.append({"type": "view", "v": v, "active": True})
+        if failover is not None:
+            logger.info(f"{RED}Node %s moved to view %s in %.3f seconds after suspecting the primary!{RESET}", self.node_id, v, failover)
+        else: logger.info(f"{RED}Node %s moved to view %s{RESET}", self.node_id, v)
+        is_primary = (v % self.nodes_num == self.node_id)
+        for preprepare in preprepares:
+            if is_primary:
+                self.log_message(preprepare.request); self.log_message(preprepare)
+                self.preprepare_messages[(v, preprepare.n)] = preprepare
+            elif self.accept_preprepare_message(preprepare, True): self.broadcast_prepare_message(preprepare)
+            else: continue
+            self.start_timer(preprepare.n)
+            self.check_for_commit(v, preprepare.n, preprepare.d)
+        if is_primary and self.pending_operations: self.flush_batch()
+
+    async def process_message(self, message, valid_signature):
         """process the PBFT message based on the phase."""
-        json_message = json.loads(packet["message"])
-        phase = json_message["phase"]
+        phase = message.phase
 
         if phase == "PRE-PREPARE":
-            if self.accept_preprepare_message(packet, public_key_pem):
-                print(f"{GREEN}Node {self.node_id} accepted the PRE-PREPARE message{RESET}")
-                self.broadcast_prepare_message(packet)
-                json_request = json.loads(packet["client_req"])
-                self.timer = threading.Timer(timeout, self.ignore_request, args=())
-                self.timer.start() 
-                print(f"Timer start to work with timeout {timeout} seconds!")
-                # run a thread to continuously check whether prepared(m, v, n, i) is true
-                threading.Thread(target=self.check_for_commit, 
-                    args=(json_request, json_message["v"], json_message["n"])).start()
-                # run a thread to continuously check whether commited-local(m, v, n, i) is true
-                threading.Thread(target=self.check_for_execution, 
-                    args=(json_request, json_message["v"], json_message["n"])).start()
+            if self.accept_preprepare_message(message, valid_signature):
+                logger.debug(f"{GREEN}Node %s accepted the PRE-PREPARE message{RESET}", self.node_id)
+                self.broadcast_prepare_message(message)
+                self.start_timer(message.n)
+                # PREPAREs that arrived before the PRE-PREPARE may already form a quorum
+                self.check_for_commit(message.v, message.n, message.d)
+        elif phase == "REQUEST":
+            if self.accept_request(message):
+                logger.debug(f"{GREEN}Node %s accepted the REQUEST of client %s{RESET}", self.node_id, message.fields["c"])
+                self.receive_request(message)
         elif phase == "PREPARE":
-            if self.accept_prepare_message(packet, public_key_pem):
-                self.message_log.append(json_message)
-                print(f"{GREEN}Node {self.node_id} accepted the PREPARE message{RESET}")
+            if self.accept_prepare_message(message, valid_signature):
+                self.log_message(message)
+                logger.debug(f"{GREEN}Node %s accepted the PREPARE message{RESET}", self.node_id)
+                self.check_for_commit(message.v, message.n, message.d)
         elif phase == "COMMIT":
-            if self.accept_commit_message(packet, public_key_pem):
-                self.message_log.append(json_message)
-                print(f"{GREEN}Node {self.node_id} accepted the COMMIT message{RESET}")
-        else: print(f"Invalid message! {json_message}")
-
-    def accept_preprepare_message(self, packet, primary_public_key):
-        signed_message = packet["signed_message"]
-        json_message = json.loads(packet["message"])
-        string_message = json.dumps(json_message)
-        
-        json_request = json.loads(packet["client_req"])
-
-        valid_primary_msg = self.verify_signature(primary_public_key, string_message, signed_message)
-        valid_digest = (self.get_digest(json_request) == json_message["d"])
-        valid_sequence = (h < json_message["n"] and json_message["n"] < H)
-        valid_view = (self.view == json_message["v"])
-        no_previous_request = True
-        for log in self.message_log:
-            if (log["phase"] == "PRE-PREPARE" and log["d"] != json_message["d"] 
-            and log["v"] == json_message["v"] and log["n"] == json_message["n"]):
-                no_previous_request = False
+            if self.accept_commit_message(message, valid_signature):
+                self.log_message(message)
+                logger.debug(f"{GREEN}Node %s accepted the COMMIT message{RESET}", self.node_id)
+                self.check_for_execution(message.v, message.n, message.d)
+        elif phase in ("PREPARE-CERTIFICATE", "COMMIT-CERTIFICATE"):
+            if self.accept_certificate_message(message, valid_signature):
+                logger.debug(f"{GREEN}Node %s accepted the %s message{RESET}", self.node_id, phase)
+                for vote in message.embedded("Q"):
+                    if vote.i not in self.certificates.get((vote.v, vote.n, vote.d, vote.phase), {}): self.log_message(vote)
+                if phase == "PREPARE-CERTIFICATE": self.check_for_commit(message.v, message.n, message.d)
+                else: self.check_for_execution(message.v, message.n, message.d)
+        elif phase == "VIEW-CHANGE":
+            if self.accept_view_change_message(message, valid_signature):
+                logger.debug(f"{GREEN}Node %s accepted the VIEW-CHANGE message for view %s{RESET}", self.node_id, message.v)
+                self.log_view_change(message)
+        elif phase == "NEW-VIEW":
+            if self.accept_new_view_message(message, valid_signature):
+                logger.debug(f"{GREEN}Node %s accepted the NEW-VIEW message for view %s{RESET}", self.node_id, message.v)
+                # the embedded messages were decoded and their signatures verified while accepting
+                self.last_new_view = message
+                self.install_new_view(message.v, self.proven_checkpoint(message.embedded("V")), message.embedded("O"))
+        elif phase == "CHECKPOINT":
+            if self.accept_checkpoint_message(message, valid_signature):
+                logger.debug(f"{GREEN}Node %s accepted the CHECKPOINT message{RESET}", self.node_id)
+                self.log_checkpoint(message)
+            elif valid_signature and message.n < self.h and self.checkpoint_message:
+                # the sender has not seen our checkpoint become stable: tell it about our latest one
+                self.send_message(self.base_port + message.i, self.checkpoint_message)
+        # the state transfer messages need no signature: whatever they carry is checked against a stable checkpoint
+        elif phase == "STATE-REQUEST": self.send_manifest(message)
+        elif phase == "STATE-MANIFEST": self.receive_manifest(message)
+        elif phase == "CHUNK-REQUEST": self.send_chunks(message)
+        elif phase == "CHUNK": self.receive_chunk(message)
+        else: logger.warning("Invalid message! %s", message)
+
+    def accept_request(self, message):
+        # a request relayed by a backup is checked against the client's key, not the sender's
+        return self.verify_message(self.client_keys.get(message.fields["c"]), message)
+
+    def accept_preprepare_message(self, message, valid_signature):
+        valid_primary_msg = valid_signature
+        valid_digest = (message.request is not None and message.request.digest == message.d)
+        valid_sequence = (self.h < message.n and message.n < self.H)
+        if message.n >= self.H and valid_signature:
+            # the primary is far ahead of us, or our checkpoint did not become stable because CHECKPOINTs were lost
+            self.resend_checkpoint(); self.request_state(self.last_executed + 1)
+        valid_view = (self.view == message.v and self.view_active)
+        no_previous_request = (self.preprepares.get((message.v, message.n), message.d) == message.d)
         if (valid_primary_msg and no_previous_request
-            and valid_view and valid_digest and valid_sequence): return True
+            and valid_view and valid_digest and valid_sequence and self.valid_batch(message.request)): return True
         else: return False
 
-    def accept_prepare_message(self, packet, replica_public_key):
-        signed_message = packet["signed_message"]
-        json_message = json.loads(packet["message"])
-        string_message = json.dumps(json_message)
-        
-        valid_msg = self.verify_signature(replica_public_key, string_message, signed_message)
-        valid_view = (self.view == json_message["v"])
-        valid_sequence = (h < json_message["n"] and json_message["n"] < H)
+    def valid_batch(self, request):
+        """check that every operation of a batch is a request signed by its client, so the primary cannot forge one."""
+        try:
+            for operation in request.embedded("message"):
+                fields = operation.fields
+                if (operation.phase != "REQUEST" or fields.get("ro") or not isinstance(fields.get("t"), int)
+                    or not self.verify_message(self.client_keys.get(fields.get("c")), operation)): return False
+        except (KeyError, TypeError, ValueError, AttributeError): return False # not a list of signed requests
+        return True
+
+    def accept_prepare_message(self, message, valid_signature):
+        valid_msg = valid_signature and message.i != message.v % self.nodes_num # the primary does not prepare
+        valid_view = (self.view == message.v)
+        valid_sequence = (self.h < message.n and message.n < self.H)
 
         if valid_msg and valid_view and valid_sequence: return True
         else: return False
     
-    def accept_commit_message(self, packet, replica_public_key):
-        signed_message = packet["signed_message"]
-        json_message = json.loads(packet["message"])
-        string_message = json.dumps(json_message)
-        
-        valid_msg = self.verify_signature(replica_public_key, string_message, signed_message)
-        valid_view = (self.view == json_message["v"])
-        valid_sequence = (h < json_message["n"] and json_message["n"] < H)
+    def accept_commit_message(self, message, valid_signature):
+        valid_msg = valid_signature
+        valid_view = (self.view == message.v)
+        valid_sequence = (self.h < message.n and message.n < self.H)
 
         if valid_msg and valid_view and valid_sequence: return True
         else: return False
 
+    def accept_certificate_message(self, message, valid_signature):
+        valid_msg = valid_signature and message.i == self.collector(message.v)
+        valid_view = (self.view == message.v)
+        valid_sequence = (self.h < message.n and message.n < self.H)
+        if not (valid_msg and valid_view and valid_sequence): return False
+        # the certificate must carry the signed votes of a quorum for exactly this instance
+        phase = message.phase[:-len("-CERTIFICATE")]
+        signers = set()
+        for vote in message.embedded("Q"):
+            if (vote.phase == phase and (vote.v, vote.n, vote.d) == (message.v, message.n, message.d)
+                and (phase == "COMMIT" or vote.i != self.collector(message.v))
+                and self.verify_message(self.public_keys.get(vote.i), vote)):
+                signers.add(vote.i)
+        if phase == "PREPARE": return len(signers) >= 2 * max_faulty_nodes
+        else: return len(signers) >= 2 * max_faulty_nodes + 1
+
+    def accept_view_change_message(self, message, valid_signature):
+        v = message.v
+        well_formed = all(isinstance(message.fields.get(key), list) for key in ("C", "P", "Q"))
+        if valid_signature and well_formed and (v > self.view or (v == self.view and not self.view_active)): return True
+        else: return False
+
+    def accept_new_view_message(self, message, valid_signature):
+        v = message.v
+        if not valid_signature or v < self.view or (v == self.view and self.view_active): return False
+        # the NEW-VIEW must be signed by the primary of view v ...
+        primary_public_key_pem = self.public_keys.get(v % self.nodes_num)
+        if not self.verify_message(primary_public_key_pem, message): return False
+        # ... carry 2f + 1 signed VIEW-CHANGE messages for view v ...
+        senders = set()
+        for view_change in message.embedded("V"):
+            if (view_change.phase == "VIEW-CHANGE" and view_change.v == v and
+                self.verify_message(self.public_keys.get(view_change.i), view_change)):
+                senders.add(view_change.i)
+        if len(senders) < 2 * max_faulty_nodes + 1: return False
+        # ... and re-propose exactly the requests that these VIEW-CHANGE messages determine
+        min_s, requests = self.compute_new_view(message.embedded("V"))
+        proposed = {}
+        for preprepare in message.embedded("O"):
+            if (preprepare.phase != "PRE-PREPARE" or preprepare.v != v or preprepare.request is None
+                or not self.verify_message(primary_public_key_pem, preprepare)
+                or preprepare.request.digest != preprepare.d): return False
+            proposed[preprepare.n] = preprepare.d
+        if proposed == {n: request.digest for n, request in requests.items()}: return True
+        else: return False
+
+    def accept_checkpoint_message(self, message, valid_signature):
+        # checkpoints at or below the stable one are of no use anymore, and checkpoints are only taken every checkpoint_interval
+        if valid_signature and isinstance(message.n, int) and message.n > self.h and message.n % checkpoint_interval == 0: return True
+        else: return False
+
+class Client:
+    """a PBFT client: sends signed requests to the primary and waits for f + 1 matching replies."""
+    open_connection = staticmethod(asyncio.open_connection)
+
+    def __init__(self, client_id, nodes_num):
+        # clients have ids of their own, "client-<name>", which never clash with the numbers of the replicas
+        self.client_id = f"client-{client_id}"
+        self.nodes_num = nodes_num
+        self.view = 0 # the view of the latest accepted reply tells the client who the primary is
+        self.timestamp = 0
+        self.replicas = {}
+        self.public_keys = {}
+        # the requests waiting for matching replies: timestamp -> (future, {replica: (v, r)}, read_only);
+        # a request needs f + 1 of them and a read-only request 2f + 1
+        self.pending = {}
+        self.outstanding = asyncio.Semaphore(client_window) # the replicas answer at most client_window of them again
+        self.reply_tasks = []
+        self.private_key = load_private_key(keystore_dir, self.client_id, signature_scheme)
+        public_key_pem = self.private_key.public_key().public_bytes(
+                                encoding=serialization.Encoding.PEM,
+                                format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        self.string_public_key = base64.b64encode(public_key_pem).decode('utf-8')
+
+    def start(self):
+        """start the client's event loop."""
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, args=(), daemon=True).start()
+
+    def call(self, function, *args):
+        """run a function or coroutine on the client's event loop from another thread and wait for its result."""
+        async def invoke():
+            result = function(*args)
+            if asyncio.iscoroutine(result): result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(invoke(), self.loop).result()
+
+    async def connect_to_replica(self, replica_host, replica_port, replica_id):
+        """connect to a replica, send our public key and listen for its replies."""
+        try:
+            reader, writer = await self.open_connection(replica_host, replica_port)
+            self.replicas[replica_id] = writer
+            writer.write(encode_frame(Message({"phase": "HANDSHAKE", "public-key": self.string_public_key,
+                                               "id": self.client_id, "client": True})))
+            self.reply_tasks.append(self.loop.create_task(self.receive_replies(reader, writer, replica_id)))
+            logger.info("Client %s connected to replica %s", self.client_id, replica_id)
+        except Exception as e:
+            logger.warning(f"{RED}Client %s failed to connect to replica %s: %s{RESET}", self.client_id, replica_id, e)
+
+    async def receive_replies(self, reader, writer, replica_id):
+        """receive the public key and then the replies of a replica; the key is taken as the key of the replica we dialed."""
+        decoder = FrameDecoder(Message.decode)
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data: return
+            try: messages = decoder.feed(data)
+            except ValueError as e: # an oversized or undecodable frame: the rest of the stream cannot be trusted
+                logger.warning(f"{RED}Client %s dropped the connection of a replica: %s{RESET}", self.client_id, e)
+                writer.close(); return
+            for message in messages:
+                try:
+                    if message.phase == "HANDSHAKE":
+                        if message.fields["id"] != replica_id:
+                            logger.warning(f"{RED}Client %s dropped replica %s, which claims to be replica %s{RESET}",
+                                           self.client_id, replica_id, message.fields["id"])
+                            writer.close(); return
+                        self.public_keys[replica_id] = base64.b64decode(message.fields["public-key"].encode('utf-8'))
+                    elif message.phase == "REPLY": self.receive_reply(message)
+                except Exception:
+                    logger.exception(f"{RED}Client %s failed to process a message: %s{RESET}", self.client_id, message)
+
+    def receive_reply(self, message):
+        """count a signed REPLY for the current request and complete it once f + 1 replicas agree."""
+        json_message = message.fields
+        public_key_pem = self.public_keys.get(message.i)
+        pending = self.pending.get(json_message["t"])
+        if (public_key_pem is None or message.signature is None or pending is None or pending[0].done()
+            or json_message["c"] != self.client_id): return
+        if not verify_signature(load_public_key(public_key_pem), message.raw, message.signature): return
+        result, replies, read_only = pending
+        replies[json_message["i"]] = (json_message["v"], json_message["r"])
+        matching = [v for v, r in replies.values() if r == json_message["r"]]
+        quorum = 2 * max_faulty_nodes + 1 if read_only else max_faulty_nodes + 1
+        if len(matching) >= quorum:
+            self.view = max(self.view, max(matching))
+            result.set_result(json_message["r"])
+        elif read_only:
+            # the read fails (with None) once the replicas that have not answered cannot complete a quorum
+            most_common = collections.Counter(r for v, r in replies.values()).most_common(1)[0][1]
+            if most_common + self.nodes_num - len(replies) < quorum: result.set_result(None)
+
+    async def send_request(self, operation, payload=None):
+        """send the request to the primary, retransmitting it to all replicas until f + 1 replies match;
+        a client may have up to client_window requests outstanding, and later ones wait for a free slot."""
+        await self.outstanding.acquire()
+        self.timestamp = self.timestamp + 1
+        t = self.timestamp
+        fields = {"phase": "REQUEST", "o": operation, "t": t, "c": self.client_id}
+        if payload: fields["p"] = payload # carried with the request, not applied to the state
+        message = Message(fields)
+        message.signature = sign_bytes(self.private_key, message.raw)
+        result = self.loop.create_future()
+        self.pending[t] = (result, {}, False)
+        primary = self.view % self.nodes_num
+        if primary in self.replicas: self.replicas[primary].write(encode_frame(message))
+        try:
+            while True:
+                try: return await asyncio.wait_for(asyncio.shield(result), client_timeout)
+                except asyncio.TimeoutError:
+                    logger.info(f"{RED}Client %s got no reply for request %s, retransmitting it to all replicas{RESET}", self.client_id, t)
+                    for writer in self.replicas.values(): writer.write(encode_frame(message))
+        finally: del self.pending[t]; self.outstanding.release()
+
+    async def send_read(self):
+        """read the replicated state in one round trip: every replica answers a read-only request from the state
+        it executed so far; without 2f + 1 matching replies within client_timeout seconds, the read is ordered."""
+        await self.outstanding.acquire()
+        self.timestamp = self.timestamp + 1
+        t = self.timestamp
+        message = Message({"phase": "REQUEST", "o": None, "t": t, "c": self.client_id, "ro": True})
+        message.signature = sign_bytes(self.private_key, message.raw)
+        result = self.loop.create_future()
+        self.pending[t] = (result, {}, True)
+        frame = encode_frame(message)
+        for writer in self.replicas.values(): writer.write(frame)
+        try: state = await asyncio.wait_for(result, client_timeout)
+        except asyncio.TimeoutError: state = None
+        finally: del self.pending[t]; self.outstanding.release()
+        if state is not None: return state
+        logger.info(f"{RED}Client %s got no 2f + 1 matching replies for read %s, ordering it{RESET}", self.client_id, t)
+        return await self.send_request(None)
+
+    def close(self):
+        """close the connections to the replicas."""
+        for task in self.reply_tasks: task.cancel()
+        for writer in self.replicas.values(): writer.close()
+
+    def invoke(self, operation):
+        """execute an operation on the replicated state and return the result agreed on by f + 1 replicas."""
+        return self.call(self.send_request, operation)
+
+    def read(self):
+        """read the replicated state, agreed on by 2f + 1 replicas or, failing that, ordered like an operation."""
+        return self.call(self.send_read)
+
 if __name__ == '__main__':
     nodes_num = int(sys.argv[1])
     base_port = int(sys.argv[2])
     node_id = int(sys.argv[3])
     max_faulty_nodes = int(sys.argv[4])
+    if len(sys.argv) > 5: batch_size = int(sys.argv[5])
+    if len(sys.argv) > 6: metrics_port = int(sys.argv[6])
+    if len(sys.argv) > 7: log_level = logging.getLevelName(sys.argv[7].upper())
+    if len(sys.argv) > 8: collector_mode = (sys.argv[8] == "collector")
+    configure_logging()
     
     node_port = base_port + node_id
     node = Node(node_id=node_id, nodes_num=nodes_num)
@@ -334,4 +1813,4 @@ if __name__ == '__main__':
     # connect nodes to each other
     for i in range(nodes_num):
         if i != node_id:
-            node.connect_to_peer('localhost', base_port + i)
+            node.call(node.connect_to_peer, 'localhost', base_port + i)
@@ -1,4 +1,4 @@
-import socket
+import asyncio
 import threading
 import time
 import json
@@ -6,62 +6,123 @@ import hashlib
 import sys
 import random
 import base64
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives.asymmetric import utils
+import os
+import multiprocessing
+import concurrent.futures
 from cryptography.hazmat.primitives import serialization
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import FRAME_HEADER, RECV_BUFFER_SIZE, FrameDecoder, load_private_key, sign_bytes, verify_signature, verify_batch, WriteAheadLog, PeerQueue
 GREEN = "\033[92m"; RED = "\033[91m"; BLUE = "\033[34m"; RESET = "\033[0m"
 
+
+def encode_frame(json_message):
+    """encode a message as a 4-byte big-endian length followed by its json bytes."""
+    payload = json.dumps(json_message).encode('utf-8')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
 max_faulty_nodes = 0
+# with wal_dir set, a node appends every value added to its state and every new round to a write-ahead
+# log in wal_dir and sends nothing before they are on disk; the appends are made durable in groups, one
+# fsync per group, and every snapshot_interval records a snapshot replaces the log written before it
+wal_dir = None
+snapshot_interval = 50
+# every peer connection has an outbound queue of at most outbound_queue_size frames, drained by a writer
+# task of its own that sends the frames queued meanwhile as one write; a broadcast only queues its frame
+# for every peer, and the frames to a peer whose queue is full are dropped
+outbound_queue_size = 10000
+# of every pair of nodes, the one with the lower id dials the other and the connection carries the
+# messages of both; a connection that breaks is dialed again after reconnect_delay seconds, twice as long
+# after every failure up to reconnect_max_delay, while the messages to the peer wait in its queue
+reconnect_delay = 0.1
+reconnect_max_delay = 5
+
+# signatures are verified in a pool of worker processes (inline when there is a single core),
+# and the result for every (sender, message, signature) seen recently is cached
+verification_workers = os.cpu_count() if (os.cpu_count() or 1) > 1 else 0
+verification_cache_size = 100000
+
+# nodes sign with Ed25519 (or 2048-bit RSA-PSS) keys kept in keystore_dir across restarts
+signature_scheme = "ed25519"
+keystore_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keys")
+
+def decode_signature(signature_base64):
+    """the bytes of a packet's signature; a malformed one decodes to no bytes, which never verify."""
+    try: return base64.b64decode(signature_base64.encode('utf-8'), validate=True)
+    except (ValueError, AttributeError): return b""
 
 class Node:
+    # the transport: asyncio streams over TCP, replaced per node by the simulator's virtual network
+    open_connection = staticmethod(asyncio.open_connection)
+    start_server = staticmethod(asyncio.start_server)
+
     def __init__(self, node_id, nodes_num, node_port):
         self.node_id = node_id
+        self.nodes_num = nodes_num
+        # the values proposed in turn and the pause between two rounds, in seconds
+        self.operations = [1, 2, 3, 4]
+        self.round_interval = 3
+        # when the pending proposal was sent (None while there is none) and a callback that, if set, gets the
+        # time of each proposal and of its decision
+        self.proposed_at = None
+        self.on_decision = None
         self.message_log = []
         self.state = "$"
         self.round = 0
         self.node_port = node_port
-        self.is_primary = (self.round == self.node_id)
+        self.is_primary = (self.round % nodes_num == self.node_id)
         self.peers = {}
-        self.private_key, self.public_key = self.generate_rsa_keys()
-        threading.Thread(target=self.check_if_is_primary, args=()).start()
+        self.verification_pool = None
+        self.verification_cache = {}
+        self.wal = None
+        self.records_since_snapshot = 0
+        self.private_key, self.public_key = self.load_keys()
+        self.string_public_key = self.get_string_public_key()
 
-    def check_if_is_primary(self):
-        time.sleep(6) # wait a little to make sure all the nodes start to work
-        operations = [1, 2, 3, 4]
+    async def check_if_is_primary(self):
+        await asyncio.sleep(6) # wait a little to make sure all the nodes start to work
+        operations = self.operations
         index = 0
         while index < len(operations):
-            self.is_primary = (self.round == self.node_id)
+            self.is_primary = (self.round % self.nodes_num == self.node_id)
             if self.is_primary: 
                 self.consensus(operations[index])
                 self.round += 1
-            index = index + 1; time.sleep(3)
+                self.log_progress()
+            index = index + 1; await asyncio.sleep(self.round_interval)
 
-    def generate_rsa_keys(self):
-        """generate the pair of public key and private key."""
-        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    def load_keys(self):
+        """load the pair of private key and public key from the keystore."""
+        private_key = load_private_key(keystore_dir, f"node-{self.node_id}", signature_scheme)
         public_key = private_key.public_key()
         return private_key, public_key
 
     def sign_message(self, string_message):
         """sign the message to ensure its validity."""
         byte_message = string_message.encode('utf-8')
-        signature = self.private_key.sign(byte_message,
-                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                hashes.SHA256()
-        ); signature_base64 = base64.b64encode(signature).decode('utf-8')
+        signature = sign_bytes(self.private_key, byte_message)
+        signature_base64 = base64.b64encode(signature).decode('utf-8')
         return signature_base64
 
     def verify_signature(self, public_key, string_message, signature_base64):
         """check the validity of the message by verifying its signature."""
-        try:
-            byte_message = string_message.encode('utf-8')
-            signature = base64.b64decode(signature_base64.encode('utf-8'))
-            public_key.verify(signature, byte_message,
-                    padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                    hashes.SHA256()
-            ); return True
-        except Exception as e: return False
+        return verify_signature(public_key, string_message.encode('utf-8'), decode_signature(signature_base64))
+
+    async def verify_packets(self, packets, public_key_pem):
+        """verify the signatures of a batch of packets from one sender, skipping those already verified."""
+        results = [None] * len(packets); pending = []
+        for index, packet in enumerate(packets):
+            key = (public_key_pem, hashlib.sha256((packet["message"] + packet["signed_message"]).encode('utf-8')).digest())
+            results[index] = self.verification_cache.get(key)
+            if results[index] is None: pending.append((index, key))
+        if pending:
+            batch = [(public_key_pem, packets[index]["message"].encode('utf-8'), decode_signature(packets[index]["signed_message"]))
+                     for index, key in pending]
+            if self.verification_pool: verified = await self.loop.run_in_executor(self.verification_pool, verify_batch, batch)
+            else: verified = verify_batch(batch)
+            if len(self.verification_cache) + len(pending) > verification_cache_size: self.verification_cache.clear()
+            for (index, key), valid in zip(pending, verified):
+                results[index] = self.verification_cache[key] = valid
+        return results
 
     def get_string_public_key(self):
         """get the node's public key to send it to other nodes."""
@@ -71,60 +132,167 @@ class Node:
         public_key_pem_base64 = base64.b64encode(public_key_pem).decode('utf-8')
         return public_key_pem_base64
     
-    def receive_public_key(self, conn):
+    async def receive_frames(self, reader):
+        """yield, for every read from the stream, the list of messages it completed."""
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data: return
+            messages = decoder.feed(data)
+            if messages: yield messages
+
+    def receive_public_key(self, json_message):
         """receive the public key of each node."""
-        message = conn.recv(1024).decode('utf-8')
-        json_message = json.loads(message)
         print(f"{GREEN}Node {self.node_id} received the public key of the node conncted!{RESET}")
         public_key_pem = base64.b64decode(json_message["public-key"].encode('utf-8'))
-        public_key = serialization.load_pem_public_key(public_key_pem)
-        return public_key
+        return public_key_pem
 
     def start(self, host, port):
-        """start the node and listen for incoming connections."""
-        server_thread = threading.Thread(target=self.listen_for_connections, args=(host, port))
-        server_thread.start()
-
-    def listen_for_connections(self, host, port):
-        """listen for incoming messages from other nodes."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(10)
-        print(f"Node {self.node_id} listening on port {port}")
+        """start the node's event loop and listen for incoming connections."""
+        self.loop = asyncio.new_event_loop()
+        if wal_dir: self.recover()
+        if verification_workers:
+            self.verification_pool = concurrent.futures.ProcessPoolExecutor(
+                verification_workers, mp_context=multiprocessing.get_context("spawn"))
+            self.verification_pool.submit(verify_batch, []) # start the workers before the first batch
+        threading.Thread(target=self.loop.run_forever, args=()).start()
+        self.call(self.listen_for_connections, host, port)
+        asyncio.run_coroutine_threadsafe(self.check_if_is_primary(), self.loop)
 
-        while True:
-            conn, addr = server_socket.accept()
-            ip_, port_ = addr
-            public_key_pem = self.receive_public_key(conn)
-            threading.Thread(target=self.handle_message, args=(conn, public_key_pem)).start()
+    def call(self, function, *args):
+        """run a function or coroutine on the node's event loop from another thread and wait for its result."""
+        async def invoke():
+            result = function(*args)
+            if asyncio.iscoroutine(result): result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(invoke(), self.loop).result()
+
+    async def listen_for_connections(self, host, port):
+        """listen for incoming connections from other nodes."""
+        self.server = await self.start_server(self.handle_message, host, port)
+        print(f"Node {self.node_id} listening on port {port}")
     
-    def handle_message(self, conn, public_key_pem):
-        """receive the messages from other nodes."""
-        while True:
-            message = conn.recv(1024).decode('utf-8')
-            message = json.loads(message)
-            print(f"Node {self.node_id} received message: {message}")
-            threading.Thread(target=self.process_message, args=(message, public_key_pem)).start()
+    async def handle_message(self, reader, writer, dialed=None):
+        """receive the public key and then the messages of a connected node; the connection, dialed by us
+        (dialed is the peer's (host, port)) or by the peer, carries our messages to it as well."""
+        public_key_pem = None; peer_port = dialed[1] if dialed else None
+        try:
+            async for messages in self.receive_frames(reader):
+                if public_key_pem is None:
+                    handshake = messages.pop(0)
+                    try:
+                        public_key_pem = self.receive_public_key(handshake)
+                        if not dialed: peer_port = self.node_port - self.node_id + handshake["id"]
+                    except Exception as e: raise ValueError(f"an invalid handshake: {e!r}") from e
+                    if not dialed:
+                        self.peer_queue(peer_port).attach(writer, encode_frame(self.get_handshake()))
+                        print(f"Node {self.node_id} accepted the connection of peer {peer_port}")
+                    if not messages: continue
+                # all the signatures delivered by one read are verified as one batch
+                try: verified = await self.verify_packets(messages, public_key_pem)
+                except Exception as e:
+                    print(f"{RED}Node {self.node_id} failed to verify {len(messages)} messages of peer {peer_port}: {e!r}{RESET}")
+                    continue
+                for message, valid_signature in zip(messages, verified):
+                    print(f"Node {self.node_id} received message: {message}")
+                    # process each message based on its type and the state of the protocol; a message that
+                    # breaks its handler is dropped, and the connection goes on with the next one
+                    try: await self.process_message(message, valid_signature)
+                    except Exception as e:
+                        print(f"{RED}Node {self.node_id} failed to process a message of peer {peer_port}: {e!r}{RESET}")
+        except (ConnectionError, OSError) as e:
+            print(f"{RED}Node {self.node_id} lost the connection of peer {peer_port}: {e}{RESET}")
+        except ValueError as e: # an oversized or undecodable frame, or a bad handshake: the rest of the stream cannot be trusted
+            print(f"{RED}Node {self.node_id} dropped the connection of peer {peer_port}: {e}{RESET}")
+            writer.close()
+        # unless a newer connection to the peer replaced this one, the peer is disconnected until it is dialed again
+        outbox = self.peers.get(peer_port)
+        if outbox is not None and outbox.writer in (writer, None):
+            print(f"{RED}Node {self.node_id} was disconnected from peer {peer_port}{RESET}")
+            outbox.detach(writer)
+            if dialed: self.loop.create_task(self.redial_peer(*dialed))
+
+    def get_handshake(self):
+        """our id and public key, sent first on every connection."""
+        return {"public-key" : self.string_public_key, "id": self.node_id}
+
+    def peer_queue(self, peer_port):
+        """the outbound queue of a peer, created the first time it is needed."""
+        outbox = self.peers.get(peer_port)
+        if outbox is None: outbox = self.peers[peer_port] = PeerQueue(self.loop, outbound_queue_size)
+        return outbox
 
-    def connect_to_peer(self, peer_host, peer_port):
-        """connect to a peer node and send the public key."""
+    async def connect_to_peer(self, peer_host, peer_port):
+        """set up the connection to a peer node: of each pair, the node with the lower id dials the other."""
+        self.peer_queue(peer_port)
+        if peer_port - (self.node_port - self.node_id) < self.node_id: return
+        if not await self.dial_peer(peer_host, peer_port): self.loop.create_task(self.redial_peer(peer_host, peer_port))
+
+    async def dial_peer(self, peer_host, peer_port):
+        """connect to a peer node, send the public key and start reading the peer's messages."""
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((peer_host, peer_port))
-            self.peers[peer_port] = peer_socket
-            print(f"Node {self.node_id} connected to peer {peer_port}")
-            self.send_message(peer_port, {"public-key" : self.get_string_public_key()})
-            print(f"{BLUE}Node {self.node_id} sent its public key to peer {peer_port}{RESET}")
+            reader, writer = await self.open_connection(peer_host, peer_port)
         except Exception as e:
             print(f"{RED}Node {self.node_id} failed to connect to peer {peer_port}: {e}{RESET}")
+            return False
+        self.peer_queue(peer_port).attach(writer, encode_frame(self.get_handshake()))
+        print(f"Node {self.node_id} connected to peer {peer_port}")
+        self.loop.create_task(self.handle_message(reader, writer, (peer_host, peer_port)))
+        return True
+
+    async def redial_peer(self, peer_host, peer_port):
+        """dial a peer again until it answers, waiting twice as long after every failure."""
+        delay = reconnect_delay
+        while True:
+            await asyncio.sleep(delay)
+            if await self.dial_peer(peer_host, peer_port): return
+            delay = min(2 * delay, reconnect_max_delay)
+
+    def recover(self):
+        """load the latest snapshot and replay the write-ahead log after it, then keep logging."""
+        wal = WriteAheadLog(wal_dir, f"node-{self.node_id}", self.loop)
+        snapshot, records = wal.load()
+        if snapshot: self.state, self.round = snapshot["state"], snapshot["round"]
+        for record in records:
+            self.state += record["append"]; self.round = record["round"]
+        self.wal = wal
+        print(f"{GREEN}Node {self.node_id} recovered the state {self.state} and round {self.round} from {len(records)} log records{RESET}")
+
+    def log_progress(self, value=""):
+        """log the value just added to the state (if any) and the current round."""
+        if not self.wal: return
+        self.wal.append({"append": value, "round": self.round})
+        self.records_since_snapshot += 1
+        if self.records_since_snapshot >= snapshot_interval:
+            self.wal.snapshot({"state": self.state, "round": self.round}); self.records_since_snapshot = 0
 
     def send_message(self, peer_port, json_message):
-        """send a message to a peer."""
-        try:
-            self.peers[peer_port].sendall(json.dumps(json_message).encode('utf-8'))
-            print(f"{BLUE}Node {self.node_id} sent message to peer {peer_port}: {json_message}{RESET}")
-        except Exception as e:
-            print(f"{RED}Failed to send message to peer {peer_port}: {e}{RESET}")                   
+        """send a message to a peer once the records it depends on are in the write-ahead log."""
+        if self.wal: self.wal.after_sync(self.write_message, peer_port, json_message)
+        else: self.write_message(peer_port, json_message)
+
+    def broadcast_message(self, json_message):
+        """send a message to all peers: it is encoded once and queued for each of them, without waiting for any."""
+        if self.wal: self.wal.after_sync(self.write_broadcast, json_message)
+        else: self.write_broadcast(json_message)
+
+    def write_message(self, peer_port, json_message):
+        self.queue_frame(peer_port, json_message, encode_frame(json_message))
+
+    def write_broadcast(self, json_message):
+        frame = encode_frame(json_message)
+        for peer_port in list(self.peers): self.queue_frame(peer_port, json_message, frame)
+
+    def queue_frame(self, peer_port, json_message, frame):
+        """hand a frame to the outbound queue of a peer, whose writer task sends it."""
+        outbox = self.peers.get(peer_port)
+        if outbox is None: print(f"{RED}Failed to send message to peer {peer_port}: not connected{RESET}")
+        elif not outbox.put(frame): print(f"{RED}The outbound queue of peer {peer_port} is full: dropped {json_message}{RESET}")
+        else: print(f"{BLUE}Node {self.node_id} sent message to peer {peer_port}: {json_message}{RESET}")
+
+    def queue_depths(self):
+        """the number of frames waiting in the outbound queue of each peer."""
+        return {peer_port: len(outbox.frames) for peer_port, outbox in self.peers.items()}                   
 
     def send_reply_message(self, vi):
         """send a reply message to the primary after receiving the proposal."""
@@ -132,35 +300,35 @@ class Node:
         string_reply = json.dumps(json_reply)
         signed_reply = self.sign_message(string_reply)
         json_message = {"signed_message": signed_reply, "message": string_reply}
-        primary_port = self.round + (self.node_port - self.node_id)
+        primary_port = self.round % self.nodes_num + (self.node_port - self.node_id)
         self.send_message(primary_port, json_message)
             
-    def process_message(self, packet, public_key_pem):
+    async def process_message(self, packet, valid_signature):
         """process the message based on the type (proposal, reply, etc)."""
         json_message = json.loads(packet["message"])
         type = json_message["type"]
 
         if type == "RESULT":
-            if self.accept_message(packet, public_key_pem):
+            if self.accept_message(packet, valid_signature):
                 print(f"{GREEN}Node {self.node_id} accepted the RESULT message{RESET}")
                 self.state += str(json_message["next_state"])
                 self.round += 1
+                self.log_progress(str(json_message["next_state"]))
                 print(f"{RED}The current state of node {self.node_id} is {self.state}{RESET}")
-        elif type == "REPLY" and self.is_primary:
-            if self.accept_message(packet, public_key_pem):
+        elif type == "REPLY" and self.is_primary and self.proposed_at is not None:
+            if self.accept_message(packet, valid_signature):
                 print(f"{GREEN}Node {self.node_id} accepted the REPLY message{RESET}")
                 self.message_log.append(json_message)
+                self.check_for_next_state()
         elif type == "PROPOSAL":
-            if self.accept_message(packet, public_key_pem):
+            if self.accept_message(packet, valid_signature):
                 print(f"{GREEN}Node {self.node_id} accepted the PROPOSAL message{RESET}")
                 self.send_reply_message(random.randint(5, 10))
         else: print(f"Invalid message! {json_message}")
 
-    def accept_message(self, packet, replica_public_key):
+    def accept_message(self, packet, valid_signature):
         """accept a message if its signature is verified"""
-        signed_message = packet["signed_message"]
-        message = packet["message"]
-        valid_msg = self.verify_signature(replica_public_key, message, signed_message)
+        valid_msg = valid_signature
         if valid_msg: return True
         else: return False
 
@@ -170,27 +338,29 @@ class Node:
         string_message = json.dumps(json_message)
         signed_message = self.sign_message(string_message)
         self.message_log.append(json_message)
-        for peer_port in self.peers:
-            self.send_message(peer_port, {"signed_message": signed_message, "message": string_message})
-        threading.Thread(target=self.check_for_next_state, args=()).start()
+        self.broadcast_message({"signed_message": signed_message, "message": string_message})
+        self.proposed_at = self.loop.time()
     
     def check_for_next_state(self):
-        """continuously check if f + 1 reply messages has been received."""
-        while True:
-            unique_ids = set()
-            for item in self.message_log:
-                if item["type"] == "REPLY": unique_ids.add(item["id"])
-            predicate = (len(unique_ids) >= max_faulty_nodes + 1)
-            time.sleep(1)
-            if predicate: 
-                print(f"Primary received at least f + 1 reply messages")
-                min_value = min([item["message"] for item in self.message_log])
-                self.state += str(min_value)
-                print(f"{RED}The current state of node {self.node_id} is {self.state}{RESET}")
-                self.message_log = []; break
-            else: continue
+        """decide the next state as soon as f + 1 reply messages have been received."""
+        unique_ids = set()
+        for item in self.message_log:
+            if item["type"] == "REPLY": unique_ids.add(item["id"])
+        if len(unique_ids) < max_faulty_nodes + 1: return
+        print(f"Primary received at least f + 1 reply messages")
+        min_value = min([item["message"] for item in self.message_log])
+        self.state += str(min_value)
+        self.log_progress(str(min_value))
+        print(f"{RED}The current state of node {self.node_id} is {self.state}{RESET}")
+        self.message_log = []
+        self.decided()
         self.broadcast_next_state(min_value)
 
+    def decided(self):
+        """the pending proposal is decided: report how long it took to the on_decision callback."""
+        proposed_at, self.proposed_at = self.proposed_at, None
+        if self.on_decision: self.on_decision(proposed_at, self.loop.time())
+
     def broadcast_next_state(self, min_value):
         """broadcast the next state message to all peers."""
         print(f"{GREEN}Node {self.node_id} is going to broadcast RESULT message{RESET}")
@@ -199,8 +369,7 @@ class Node:
         signed_message1 = self.sign_message(string_message1)
 
         if self.node_id != 0:
-            for peer_port in self.peers:
-                self.send_message(peer_port, {"signed_message": signed_message1, "message": string_message1})
+            self.broadcast_message({"signed_message": signed_message1, "message": string_message1})
             return
         # Node 1 is malicous and it tells 1 node the correct min_value, while it tells the other 2 nodes a wrong value (min_value + 1) as the next state.
         # It causes fork since the messages would not be broadcasted and each node only sends its reply to the primary. 
@@ -229,4 +398,4 @@ if __name__ == '__main__':
     # connect nodes to each other
     for i in range(nodes_num):
         if i != node_id:
-            node.connect_to_peer('localhost', base_port + i)
+            node.call(node.connect_to_peer, 'localhost', base_port + i)
@@ -0,0 +1,199 @@
+import asyncio
+import itertools
+import subprocess
+import argparse
+import platform
+import random
+import json
+import time
+import csv
+import sys
+from simulator import QUESTION1_DIR, PBFTSimulation, BSMRSimulation, load_protocol, percentile
+
+FIELDS = ["protocol", "mode", "nodes", "f", "batch", "payload", "rate", "offered", "committed", "virtual_seconds", "throughput",
+          "latency_p50", "latency_p99", "messages_per_op", "bytes_per_op", "cpu_ms_per_op",
+          "prepared_ms", "committed_ms", "executed_ms", "sign_ms", "verify_ms", "wall_seconds"]
+# a higher value is a regression for these, a lower one for throughput
+LOWER_IS_BETTER = ["latency_p50", "latency_p99", "messages_per_op", "bytes_per_op", "cpu_ms_per_op"]
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=QUESTION1_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+async def open_loop(simulation, clients_num, rate, duration, payload, drain):
+    """requests arrive as a Poisson process of the given rate, whether or not the earlier ones were answered,
+    and are spread round-robin over the clients; after duration the outstanding ones get drain seconds to finish."""
+    loop = simulation.loop
+    clients = [simulation.create_client(j) for j in range(clients_num)]
+    for client in clients:
+        for replica in simulation.nodes:
+            await client.connect_to_replica('localhost', simulation.base_port + replica.node_id, replica.node_id)
+    await asyncio.sleep(0.1)
+    arrivals = random.Random(simulation.seed)
+    latencies = []; requests = []
+    async def request(client, operation):
+        start = loop.time()
+        await client.send_request(operation, "x" * payload if payload else None)
+        latencies.append(loop.time() - start)
+    start = loop.time(); index = 0
+    while True:
+        await asyncio.sleep(arrivals.expovariate(rate))
+        if loop.time() - start >= duration: break
+        requests.append(loop.create_task(request(clients[index % clients_num], (index % 9) + 1)))
+        index = index + 1
+    if requests: await asyncio.wait(requests, timeout=drain)
+    return start, len(requests), latencies
+
+def mean_milliseconds(snapshots, series):
+    """the mean, over all the replicas' observations, of a histogram of their metrics snapshots."""
+    histograms = [snapshot["histograms"][series] for snapshot in snapshots if series in snapshot["histograms"]]
+    count = sum(histogram["count"] for histogram in histograms)
+    return round(sum(histogram["sum"] for histogram in histograms) * 1000 / count, 4) if count else None
+
+def phase_breakdown(simulation):
+    """where the time of an operation goes: the phases of the replicas and their signing and verification."""
+    snapshots = [node.metrics_snapshot() for node in simulation.nodes]
+    return {"prepared_ms": mean_milliseconds(snapshots, 'pbft_phase_seconds{phase="prepared"}'),
+            "committed_ms": mean_milliseconds(snapshots, 'pbft_phase_seconds{phase="committed"}'),
+            "executed_ms": mean_milliseconds(snapshots, 'pbft_phase_seconds{phase="executed"}'),
+            "sign_ms": mean_milliseconds(snapshots, "pbft_sign_seconds"),
+            "verify_ms": mean_milliseconds(snapshots, "pbft_verify_seconds")}
+
+def run_pbft(mode, nodes_num, max_faulty_nodes, batch, payload, rate, duration, clients_num, drain, seed, network_options):
+    module = load_protocol("pbft")
+    module.batch_size = batch
+    module.collector_mode = (mode == "collector")
+    module.malicious_primary = None # measure the protocol, not the assignment's view change
+    simulation = PBFTSimulation(module, nodes_num, max_faulty_nodes, seed=seed, **network_options)
+    simulation.seed = seed
+    simulation.run(simulation.connect())
+    messages, sent_bytes, cpu = simulation.network.messages, simulation.network.bytes, time.process_time()
+    start, offered, latencies = simulation.run(open_loop(simulation, clients_num, rate, duration, payload, drain))
+    return simulation, start, simulation.loop.time(), offered, latencies, messages, sent_bytes, cpu
+
+def run_bsmr(protocol, nodes_num, max_faulty_nodes, rate, duration, drain, seed, network_options):
+    """the BSMR replicas propose on their own, one value per round: the rate sets the rounds per second and the
+    latency of a round runs from the primary's proposal to its broadcast of the next state."""
+    module = load_protocol(protocol)
+    simulation = BSMRSimulation(module, nodes_num, max_faulty_nodes, seed=seed, **network_options)
+    rounds = max(1, int(rate * duration))
+    latencies = []; decided = []
+    def on_decision(proposed_at, decided_at):
+        decided.append(decided_at); latencies.append(decided_at - proposed_at)
+    for node in simulation.nodes:
+        node.operations = [(operation % 9) + 1 for operation in range(rounds)]
+        node.round_interval = 1 / rate
+        node.on_decision = on_decision
+    simulation.run(simulation.connect())
+    messages, sent_bytes, cpu = simulation.network.messages, simulation.network.bytes, time.process_time()
+    start = simulation.loop.time() + 6 # the replicas' driver waits 6 seconds before the first round
+    for node in simulation.nodes: simulation.loop.create_task(node.check_if_is_primary())
+    simulation.run_for(6 + rounds / rate + drain)
+    end = decided[-1] if decided else simulation.loop.time()
+    return simulation, start, end, rounds, latencies, messages, sent_bytes, cpu
+
+def benchmark(protocol, nodes_num, max_faulty_nodes, batch, payload, rate, duration, clients_num=4, drain=30, seed=0, mode="all-to-all", **network_options):
+    """run one configuration and report its throughput, latency and cost per committed operation."""
+    wall_start = time.perf_counter()
+    if protocol == "pbft":
+        simulation, start, end, offered, latencies, messages, sent_bytes, cpu = run_pbft(
+            mode, nodes_num, max_faulty_nodes, batch, payload, rate, duration, clients_num, drain, seed, network_options)
+    else:
+        simulation, start, end, offered, latencies, messages, sent_bytes, cpu = run_bsmr(
+            protocol, nodes_num, max_faulty_nodes, rate, duration, drain, seed, network_options)
+        batch = payload = mode = None # the BSMR replicas propose one value per round and carry no payload
+    cpu = time.process_time() - cpu
+    breakdown = phase_breakdown(simulation) if protocol == "pbft" else dict.fromkeys(["prepared_ms", "committed_ms", "executed_ms", "sign_ms", "verify_ms"])
+    virtual_time = end - start
+    messages, sent_bytes = simulation.network.messages - messages, simulation.network.bytes - sent_bytes
+    simulation.close()
+    committed = len(latencies)
+    per_op = lambda value, digits: round(value / committed, digits) if committed else None
+    return {"protocol": protocol, "mode": mode, "nodes": nodes_num, "f": max_faulty_nodes, "batch": batch, "payload": payload,
+            "rate": rate, "offered": offered, "committed": committed, "virtual_seconds": round(virtual_time, 6),
+            "throughput": round(committed / virtual_time, 3) if virtual_time else None,
+            "latency_p50": percentile(latencies, 0.5), "latency_p99": percentile(latencies, 0.99),
+            "messages_per_op": per_op(messages, 2), "bytes_per_op": per_op(sent_bytes, 1),
+            "cpu_ms_per_op": per_op(cpu * 1000, 3), **breakdown, "wall_seconds": round(time.perf_counter() - wall_start, 3)}
+
+def sweep(args):
+    """every combination of the swept parameters; mode, batch and payload only vary for PBFT."""
+    for protocol, nodes_num in itertools.product(args.protocols, args.nodes):
+        for max_faulty_nodes in (args.f or [(nodes_num - 1) // 3]):
+            pbft = protocol == "pbft"
+            for mode, batch, payload in itertools.product(args.modes if pbft else [None], args.batch if pbft else [1],
+                                                          args.payload if pbft else [0]):
+                yield dict(protocol=protocol, mode=mode, nodes_num=nodes_num, max_faulty_nodes=max_faulty_nodes, batch=batch,
+                           payload=payload, rate=args.rate, duration=args.duration, clients_num=args.clients,
+                           drain=args.drain, seed=args.seed, latency=args.latency, jitter=args.jitter,
+                           bandwidth=args.bandwidth, loss=args.loss)
+
+def configuration(result):
+    # results recorded before the collector mode existed ran PBFT all-to-all
+    mode = result.get("mode", "all-to-all" if result["protocol"] == "pbft" else None)
+    return (result["protocol"], mode) + tuple(result[key] for key in ["nodes", "f", "batch", "payload", "rate"])
+
+def compare(results, baseline, threshold):
+    """the metrics that got worse than the baseline run by more than threshold (a fraction)."""
+    previous = {configuration(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(configuration(result))
+        if old is None: continue
+        for key in LOWER_IS_BETTER + ["throughput"]:
+            if old[key] is None or result[key] is None or old[key] == 0: continue
+            change = (result[key] - old[key]) / old[key]
+            if (change if key in LOWER_IS_BETTER else -change) > threshold:
+                regressions.append({"configuration": configuration(result), "metric": key, "baseline": old[key],
+                                    "current": result[key], "change": round(change, 3)})
+    return regressions
+
+def write_results(run, output_format, output):
+    if output_format == "json":
+        json.dump(run, output, indent=2); output.write("\n")
+        return
+    writer = csv.DictWriter(output, fieldnames=["commit", "seed"] + FIELDS)
+    writer.writeheader()
+    for result in run["results"]: writer.writerow({"commit": run["commit"], "seed": run["seed"], **result})
+
+def integers(text):
+    return [int(value) for value in text.split(",")]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark PBFT and BSMR on the simulator under an open-loop load")
+    parser.add_argument("--protocols", type=lambda text: text.split(","), default=["pbft"], help="e.g. pbft,bsmr1,bsmr2")
+    parser.add_argument("--nodes", type=integers, default=[4], help="e.g. 4,7,10")
+    parser.add_argument("--f", type=integers, default=None, help="default: (nodes - 1) // 3")
+    parser.add_argument("--modes", type=lambda text: text.split(","), default=["all-to-all"],
+                        help="PBFT vote dissemination, e.g. all-to-all,collector")
+    parser.add_argument("--batch", type=integers, default=[1], help="PBFT batch sizes")
+    parser.add_argument("--payload", type=integers, default=[0], help="PBFT request payloads in bytes")
+    parser.add_argument("--rate", type=float, default=50, help="offered requests per virtual second (BSMR: rounds)")
+    parser.add_argument("--duration", type=float, default=5, help="virtual seconds of offered load")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--drain", type=float, default=30, help="virtual seconds left to the outstanding requests")
+    parser.add_argument("--latency", type=float, default=0.001, help="one-way latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per link")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--output", default=None, help="file to write the results to (default: stdout)")
+    parser.add_argument("--compare", default=None, help="a JSON result of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+    results = []
+    for parameters in sweep(args):
+        results.append(benchmark(**parameters))
+        print(f"{parameters['protocol']} mode={parameters['mode']} n={parameters['nodes_num']} f={parameters['max_faulty_nodes']} "
+              f"batch={parameters['batch']} payload={parameters['payload']}: {results[-1]['throughput']} ops/s", file=sys.stderr)
+    run = {"commit": git_commit(), "python": platform.python_version(), "seed": args.seed,
+           "arguments": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "format")},
+           "results": results}
+    if args.output:
+        with open(args.output, "w", newline="") as output: write_results(run, args.format, output)
+    else: write_results(run, args.format, sys.stdout)
+    if args.compare:
+        with open(args.compare) as baseline_file: regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions: print(f"regression: {regression}", file=sys.stderr)
+        if regressions: sys.exit(1)
@@ -0,0 +1,335 @@
+import asyncio
+import concurrent.futures
+import collections
+import struct
+import json
+import math
+import zlib
+import os
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, ed25519
+from cryptography.hazmat.primitives import serialization
+
+# the pieces shared by the PBFT and BSMR replicas (Question1) and the HTLC nodes (Question2)
+RED = "\033[91m"; RESET = "\033[0m"
+
+FRAME_HEADER = struct.Struct('>I'); RECV_BUFFER_SIZE = 65536
+# a frame may carry at most MAX_FRAME bytes; a longer one is refused before it is buffered, and the
+# connection it arrived on is dropped, so a peer cannot make a node hold an unbounded frame in memory
+MAX_FRAME = 16 * 1024 * 1024
+# a write-ahead log record: the length and the CRC-32 of its json body
+WAL_RECORD_HEADER = struct.Struct('>II')
+
+class FrameDecoder:
+    """incrementally split a byte stream into length-prefixed messages, each decoded by decode (json by default)."""
+    def __init__(self, decode=json.loads, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.decode = decode; self.max_frame = max_frame
+
+    def feed(self, data):
+        """append newly received bytes and return every message they complete; a frame longer than
+        max_frame, or one that does not decode, raises ValueError."""
+        self.buffer += data
+        messages = []; start = 0; end = len(self.buffer)
+        while end - start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, start)
+            if length > self.max_frame: raise ValueError(f"a frame of {length} bytes exceeds the limit of {self.max_frame} bytes")
+            if end - start - FRAME_HEADER.size < length: break
+            start += FRAME_HEADER.size
+            try: messages.append(self.decode(bytes(self.buffer[start:start + length])))
+            except Exception as e: raise ValueError(f"a frame of {length} bytes does not decode: {e!r}") from e
+            start += length
+        if start: del self.buffer[:start]
+        return messages
+
+def generate_private_key(scheme):
+    """generate a fresh private key for the given signature scheme."""
+    if scheme == "ed25519": return ed25519.Ed25519PrivateKey.generate()
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+def load_private_key(directory, name, scheme):
+    """load the private key of name from the keystore in directory, generating and storing it on first start."""
+    path = os.path.join(directory, f"{name}-{scheme}.pem")
+    if os.path.exists(path):
+        with open(path, "rb") as key_file:
+            # the keystore only holds keys this node generated itself, so the RSA consistency check is skipped
+            return serialization.load_pem_private_key(key_file.read(), password=None,
+                                                      unsafe_skip_rsa_key_validation=True)
+    private_key = generate_private_key(scheme)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # only the owner may read the key file, whatever the umask
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as key_file:
+        key_file.write(private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                                 format=serialization.PrivateFormat.PKCS8,
+                                                 encryption_algorithm=serialization.NoEncryption()))
+    return private_key
+
+def sign_bytes(private_key, byte_message):
+    """sign bytes with an Ed25519 or RSA-PSS private key."""
+    if isinstance(private_key, ed25519.Ed25519PrivateKey): return private_key.sign(byte_message)
+    return private_key.sign(byte_message,
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            hashes.SHA256())
+
+# the public keys parsed so far, by their PEM bytes (in each process that verifies signatures)
+parsed_public_keys = {}
+
+def load_public_key(public_key_pem):
+    """parse a peer's PEM public key once and reuse the parsed key afterwards."""
+    public_key = parsed_public_keys.get(public_key_pem)
+    if public_key is None:
+        public_key = parsed_public_keys[public_key_pem] = serialization.load_pem_public_key(public_key_pem)
+    return public_key
+
+def verify_signature(public_key, byte_message, signature):
+    """check the validity of the message by verifying its signature."""
+    try:
+        if isinstance(public_key, ed25519.Ed25519PublicKey): public_key.verify(signature, byte_message)
+        else: public_key.verify(signature, byte_message,
+                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                hashes.SHA256())
+        return True
+    except Exception as e: return False
+
+def verify_batch(items):
+    """verify a batch of (public key pem, message bytes, signature) triples, parsing each key once per process."""
+    results = []
+    for public_key_pem, byte_message, signature in items:
+        results.append(verify_signature(load_public_key(public_key_pem), byte_message, signature))
+    return results
+
+class WheelTimer:
+    """a timeout kept by a TimerWheel; like the loop's timer handles, it can be cancelled."""
+    __slots__ = ("wheel", "deadline", "callback", "args")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel; self.deadline = deadline
+        self.callback = callback; self.args = args
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+class TimerWheel:
+    """a hashed timer wheel on an event loop: a timeout goes into the slot of the tick it expires at, so
+    scheduling and cancelling one take O(1) however many are pending, and a single loop timer wakes the
+    wheel at the next tick whose slot is not empty. The callbacks run on the loop."""
+    def __init__(self, loop, tick, slots):
+        self.loop = loop; self.tick = tick
+        self.slots = [set() for slot in range(slots)]
+        # ticks count from origin; position is the last tick whose slot was processed
+        self.origin = loop.time(); self.position = 0
+        self.pending = 0
+        self.handle = None; self.next_tick = None
+
+    def call_later(self, delay, callback, *args):
+        """run callback(*args) on the loop after delay seconds, rounded up to the next tick."""
+        deadline = max(self.position + 1, math.ceil((self.loop.time() + delay - self.origin) / self.tick))
+        timer = WheelTimer(self, deadline, callback, args)
+        self.slots[deadline % len(self.slots)].add(timer)
+        self.pending += 1
+        if self.handle is None or deadline < self.next_tick:
+            if self.handle: self.handle.cancel()
+            self.schedule()
+        return timer
+
+    def cancel(self, timer):
+        slot = self.slots[timer.deadline % len(self.slots)]
+        if timer not in slot: return
+        slot.discard(timer); self.pending -= 1
+        if not self.pending and self.handle:
+            self.handle.cancel(); self.handle = None
+
+    def schedule(self):
+        """wake up at the next tick whose slot holds a timeout, at most one turn of the wheel ahead."""
+        slots = len(self.slots)
+        for position in range(self.position + 1, self.position + slots + 1):
+            if self.slots[position % slots]: break
+        self.next_tick = position
+        self.handle = self.loop.call_at(self.origin + position * self.tick, self.advance)
+
+    def advance(self):
+        """expire the timeouts of every tick up to now; a turn later than a whole turn visits each slot once."""
+        now = max(self.next_tick, math.floor((self.loop.time() - self.origin) / self.tick))
+        slots = len(self.slots)
+        for position in range(self.position + 1, min(now, self.position + slots) + 1):
+            slot = self.slots[position % slots]
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                slot.discard(timer); self.pending -= 1
+                self.loop.call_soon(timer.callback, *timer.args)
+        self.position = now; self.handle = None
+        if self.pending: self.schedule()
+
+class WriteAheadLog:
+    """an append-only log of json records in numbered segment files, next to the latest snapshot.
+    A worker thread writes and fsyncs the appended records in groups: everything appended while
+    one group is being synced goes to disk with the next fsync."""
+    def __init__(self, directory, name, loop, report=print):
+        self.directory = directory
+        self.name = name
+        self.loop = loop
+        self.report = report # called with the message of a failed write
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, f"{name}.snapshot")
+        self.segment = max(self.segments(), default=0) + 1 # every start writes to a fresh segment
+        self.file = None
+        self.buffer = []
+        self.flush_scheduled = False
+        self.syncing = False
+        # appends are counted; callbacks wait in order until the records appended before them are synced
+        self.appended = 0; self.synced = 0
+        self.waiting = collections.deque()
+        self.groups = 0
+        # the error of the first group that failed to reach the disk; from then on the log fails stop
+        self.failure = None
+        self.worker = concurrent.futures.ThreadPoolExecutor(1)
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, f"{self.name}.{index:08d}.wal")
+
+    def segments(self):
+        prefix = self.name + "."
+        return sorted(int(entry[len(prefix):-4]) for entry in os.listdir(self.directory)
+                      if entry.startswith(prefix) and entry.endswith(".wal"))
+
+    def load(self):
+        """the latest snapshot (or None) and the records appended after it, in order; a record torn
+        by a crash ends its segment."""
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as snapshot_file: snapshot = json.loads(snapshot_file.read())
+        first_segment = snapshot["segment"] if snapshot else 0
+        records = []
+        for index in self.segments():
+            if index < first_segment: continue
+            with open(self.segment_path(index), "rb") as segment_file: data = segment_file.read()
+            start = 0
+            while start + WAL_RECORD_HEADER.size <= len(data):
+                length, checksum = WAL_RECORD_HEADER.unpack_from(data, start)
+                body = data[start + WAL_RECORD_HEADER.size:start + WAL_RECORD_HEADER.size + length]
+                if len(body) < length or zlib.crc32(body) != checksum: break
+                records.append(json.loads(body))
+                start += WAL_RECORD_HEADER.size + length
+        return snapshot, records
+
+    def append(self, record):
+        if self.failure: return
+        body = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        self.buffer.append(WAL_RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+        self.appended += 1
+        self.schedule_flush()
+
+    def snapshot(self, fields):
+        """replace the snapshot once the records appended before it are synced, and start a new segment."""
+        if self.failure: return
+        self.buffer.append(fields)
+        self.appended += 1
+        self.schedule_flush()
+
+    def after_sync(self, callback, *args):
+        """run callback once every record appended so far is on disk; never, once a write has failed."""
+        if self.failure: return
+        if self.synced == self.appended: callback(*args)
+        else: self.waiting.append((self.appended, callback, args))
+
+    def schedule_flush(self):
+        # the records appended during one iteration of the event loop form (at least) one group
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.syncing or self.failure or not self.buffer: return
+        items, self.buffer = self.buffer, []
+        self.syncing = True
+        target = self.appended
+        self.loop.run_in_executor(self.worker, self.write, items).add_done_callback(
+            lambda future: self.synced_up_to(target, future))
+
+    def write(self, items):
+        """write a group of records and snapshots and fsync it (on the worker thread)."""
+        if self.file is None: self.file = open(self.segment_path(self.segment), "ab")
+        for item in items:
+            if isinstance(item, bytes):
+                self.file.write(item); continue
+            self.file.flush(); os.fsync(self.file.fileno())
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), "ab")
+            temporary_path = self.snapshot_path + ".tmp"
+            with open(temporary_path, "wb") as snapshot_file:
+                snapshot_file.write(json.dumps(dict(item, segment=self.segment), separators=(',', ':')).encode('utf-8'))
+                snapshot_file.flush(); os.fsync(snapshot_file.fileno())
+            os.replace(temporary_path, self.snapshot_path)
+            for index in self.segments():
+                if index < self.segment: os.remove(self.segment_path(index))
+        self.file.flush(); os.fsync(self.file.fileno())
+
+    def synced_up_to(self, target, future):
+        self.syncing = False
+        if future.exception() is not None:
+            # the group's records are lost, so nothing that waits for them, or for any later record, may go out
+            self.failure = future.exception()
+            self.buffer = []; self.waiting.clear()
+            self.report(f"{RED}The write-ahead log {self.name} failed, and the node sends nothing more: {self.failure}{RESET}")
+            return
+        self.synced = target; self.groups += 1
+        while self.waiting and self.waiting[0][0] <= target:
+            appended, callback, args = self.waiting.popleft()
+            callback(*args)
+        self.flush()
+
+    def close(self):
+        self.worker.shutdown()
+        if self.file: self.file.close()
+
+class PeerQueue:
+    """the bounded outbound queue of one peer and the task that drains it into the peer's current connection;
+    while the peer is disconnected, the frames wait in the queue for the next connection."""
+    def __init__(self, loop, limit, report=print):
+        self.writer = None; self.limit = limit
+        self.report = report # called with the message of a failed write
+        self.frames = collections.deque()
+        self.ready = asyncio.Event(); self.connected = asyncio.Event()
+        self.writes = 0; self.dropped = 0; self.connections = 0
+        self.task = loop.create_task(self.drain_frames())
+
+    def attach(self, writer, handshake):
+        """send over a new connection to the peer, our handshake first; it replaces the previous one."""
+        if self.writer is not None and self.writer is not writer: self.writer.close()
+        writer.write(handshake)
+        self.writer = writer; self.connections += 1
+        self.connected.set()
+
+    def detach(self, writer):
+        """the connection broke: keep queueing until the next one."""
+        if self.writer is not writer: return
+        self.writer = None; self.connected.clear()
+        writer.close()
+
+    def put(self, frame):
+        """queue a frame, unless the queue is full; never waits."""
+        if len(self.frames) >= self.limit:
+            self.dropped += 1; return False
+        self.frames.append(frame); self.ready.set()
+        return True
+
+    async def drain_frames(self):
+        """write everything queued as one vectored write, then wait for the connection to take it."""
+        while True:
+            await self.ready.wait(); await self.connected.wait()
+            writer = self.writer
+            if writer.is_closing(): # broken, but its reader has not noticed yet: the frames wait for the next one
+                self.detach(writer); continue
+            self.ready.clear()
+            frames = list(self.frames); self.frames.clear()
+            try:
+                writer.writelines(frames); self.writes += 1
+                await writer.drain()
+            except (ConnectionError, OSError) as e:
+                self.report(f"{RED}The connection of an outbound queue failed: {e}{RESET}")
+                self.detach(writer)
+
+    def close(self):
+        self.task.cancel()
+        if self.writer: self.writer.close()
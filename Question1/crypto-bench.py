@@ -0,0 +1,31 @@
+import time
+import tempfile
+import common
+
+def time_per_call(function, repetitions):
+    """average wall-clock time of one call, in milliseconds."""
+    start = time.perf_counter()
+    for i in range(repetitions): function()
+    return (time.perf_counter() - start) * 1000 / repetitions
+
+def benchmark_scheme(scheme, repetitions):
+    """measure key generation, keystore loading, signing and verification for one signature scheme."""
+    keystore_dir = tempfile.mkdtemp()
+    common.load_private_key(keystore_dir, "node-0", scheme) # the first call generates the key and stores it in the keystore
+    private_key = common.load_private_key(keystore_dir, "node-0", scheme)
+    public_key = private_key.public_key()
+    byte_message = b'{"phase": "PRE-PREPARE", "v": 0, "n": 2, "d": "' + b"0" * 64 + b'"}'
+    signature = common.sign_bytes(private_key, byte_message)
+    return {"scheme": scheme,
+            "keygen_ms": time_per_call(lambda: common.generate_private_key(scheme), max(repetitions // 100, 3)),
+            "keystore_load_ms": time_per_call(lambda: common.load_private_key(keystore_dir, "node-0", scheme), repetitions // 10),
+            "sign_ms": time_per_call(lambda: common.sign_bytes(private_key, byte_message), repetitions),
+            "verify_ms": time_per_call(lambda: common.verify_signature(public_key, byte_message, signature), repetitions),
+            "signature_bytes": len(signature)}
+
+repetitions = 500
+print(f"{'scheme':>8} {'keygen ms':>10} {'load ms':>8} {'sign ms':>8} {'verify ms':>10} {'sig bytes':>10}")
+for scheme in ["rsa", "ed25519"]:
+    result = benchmark_scheme(scheme, repetitions)
+    print(f"{result['scheme']:>8} {result['keygen_ms']:>10.3f} {result['keystore_load_ms']:>8.3f} "
+          f"{result['sign_ms']:>8.3f} {result['verify_ms']:>10.3f} {result['signature_bytes']:>10}")
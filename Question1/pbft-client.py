@@ -0,0 +1,26 @@
+import sys
+import time
+import PBFT
+
+nodes_num = int(sys.argv[1])
+base_port = int(sys.argv[2])
+PBFT.max_faulty_nodes = int(sys.argv[3])
+client_id = sys.argv[4] if len(sys.argv) > 4 else "0"
+
+PBFT.configure_logging()
+client = PBFT.Client(client_id=client_id, nodes_num=nodes_num)
+client.start()
+time.sleep(6) # wait a little to make sure all the replicas are connected to each other
+for i in range(nodes_num):
+    client.call(client.connect_to_replica, 'localhost', base_port + i, i)
+time.sleep(1)
+
+operations = [1, 2, 3, 4]
+for operation in operations:
+    start = time.time()
+    result = client.invoke(operation)
+    print(f"{PBFT.GREEN}Client {client.client_id} executed operation {operation} in {time.time() - start:.3f} seconds, the state is {result}{PBFT.RESET}")
+start = time.time()
+result = client.read()
+print(f"{PBFT.GREEN}Client {client.client_id} read the state {result} in {time.time() - start:.3f} seconds{PBFT.RESET}")
+client.call(client.close)
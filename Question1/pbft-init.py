@@ -1,13 +1,19 @@
 import subprocess
 import time
 
-def open_replica_terminals(nodes_num, base_port, max_faulty_nodes):
+def open_replica_terminals(nodes_num, base_port, max_faulty_nodes, batch_size):
     for i in range(0, nodes_num):
-        command = f"python3 PBFT.py {nodes_num} {base_port} {i} {max_faulty_nodes}"
+        command = f"python3 PBFT.py {nodes_num} {base_port} {i} {max_faulty_nodes} {batch_size}"
         subprocess.Popen(["gnome-terminal", "--", "bash", "-c", command])
         #subprocess.Popen(["osascript", "-e", f'tell application "Terminal" to do script "{command}"'])
 
+def open_client_terminal(nodes_num, base_port, max_faulty_nodes):
+    command = f"python3 pbft-client.py {nodes_num} {base_port} {max_faulty_nodes}"
+    subprocess.Popen(["gnome-terminal", "--", "bash", "-c", command])
+
 max_faulty_nodes = 1
 nodes_num = 3 * max_faulty_nodes + 1
 base_port = 5060
-open_replica_terminals(nodes_num, base_port, max_faulty_nodes)
+batch_size = 1
+open_replica_terminals(nodes_num, base_port, max_faulty_nodes, batch_size)
+open_client_terminal(nodes_num, base_port, max_faulty_nodes)
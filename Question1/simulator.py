@@ -0,0 +1,293 @@
+import asyncio
+import selectors
+import importlib.util
+import contextlib
+import argparse
+import logging
+import random
+import time
+import os
+
+QUESTION1_DIR = os.path.dirname(os.path.abspath(__file__))
+PROTOCOLS = {"pbft": "PBFT.py", "bsmr1": os.path.join("Scenario 1", "BSMR1.py"), "bsmr2": os.path.join("Scenario 2", "BSMR2.py")}
+
+def load_protocol(protocol):
+    """import PBFT.py, BSMR1.py or BSMR2.py as a module."""
+    path = os.path.join(QUESTION1_DIR, PROTOCOLS[protocol])
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class VirtualSelector(selectors.SelectSelector):
+    """a selector that never waits: when the loop would sleep until its next timer, the clock jumps there."""
+    def __init__(self):
+        super().__init__()
+        self.clock = 0.0
+
+    def select(self, timeout=None):
+        if timeout: self.clock += timeout
+        return []
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """an asyncio event loop on a virtual clock: call_later, sleep and wait_for work as usual, but
+    computation takes no virtual time and idle time is skipped, so runs are fast and deterministic."""
+    def __init__(self):
+        super().__init__(VirtualSelector())
+
+    def time(self):
+        return self._selector.clock
+
+class VirtualWriter:
+    """the sending half of a virtual connection, used by the nodes like an asyncio StreamWriter."""
+    def __init__(self, network, source, destination, reader):
+        self.network = network
+        self.source = source; self.destination = destination
+        self.reader = reader
+        self.closed = False; self.written = False
+
+    def write(self, data):
+        # the first write of a connection is its handshake, which is never lost
+        if not self.closed: self.network.transmit(self.source, self.destination, data, self.reader, reliable=not self.written)
+        self.written = True
+
+    def writelines(self, chunks):
+        # a vectored write leaves as one write on the link, but still counts as one message per frame
+        if not self.closed: self.network.transmit(self.source, self.destination, b"".join(chunks), self.reader,
+                                                  reliable=not self.written, frames=len(chunks))
+        self.written = True
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    async def drain(self):
+        pass
+
+class VirtualServer:
+    def close(self):
+        pass
+
+class VirtualNetwork:
+    """point-to-point links with a latency (plus uniform jitter), a bandwidth in bytes per second shared by the
+    writes on each link, independent loss of whole writes and partitions between groups of nodes."""
+    def __init__(self, loop, latency=0.001, jitter=0.0, bandwidth=None, loss=0.0, seed=0):
+        self.loop = loop
+        self.latency = latency; self.jitter = jitter
+        self.bandwidth = bandwidth; self.loss = loss
+        self.random = random.Random(seed)
+        self.servers = {}
+        self.partition_groups = None
+        # per link: when it finishes sending the bytes already written and when its last write arrives
+        self.link_free = {}
+        self.last_delivery = {}
+        self.messages = 0; self.bytes = 0; self.dropped = 0
+
+    async def start_server(self, address, client_connected_cb, host, port):
+        self.servers[port] = (address, client_connected_cb)
+        return VirtualServer()
+
+    async def open_connection(self, address, host, port):
+        """connect address to the node listening on port and return the two halves of our end."""
+        if port not in self.servers: raise ConnectionRefusedError(f"nothing listens on virtual port {port}")
+        server_address, client_connected_cb = self.servers[port]
+        client_reader = asyncio.StreamReader(); server_reader = asyncio.StreamReader()
+        client_writer = VirtualWriter(self, address, server_address, server_reader)
+        server_writer = VirtualWriter(self, server_address, address, client_reader)
+        self.loop.create_task(client_connected_cb(server_reader, server_writer))
+        return client_reader, client_writer
+
+    def partition(self, groups):
+        """drop every write between nodes of different groups; nodes in no group reach everyone."""
+        self.partition_groups = [set(group) for group in groups]
+
+    def heal(self):
+        self.partition_groups = None
+
+    def connected(self, source, destination):
+        if self.partition_groups is None: return True
+        source_group = next((index for index, group in enumerate(self.partition_groups) if source in group), None)
+        destination_group = next((index for index, group in enumerate(self.partition_groups) if destination in group), None)
+        return source_group is None or destination_group is None or source_group == destination_group
+
+    def transmit(self, source, destination, data, reader, reliable=False, frames=1):
+        """deliver one write after its queueing, transmission and propagation delay, or drop it."""
+        if not self.connected(source, destination) or (self.loss and not reliable and self.random.random() < self.loss):
+            self.dropped += frames; return
+        self.messages += frames; self.bytes += len(data)
+        now = self.loop.time(); link = (source, destination)
+        sent = max(now, self.link_free.get(link, now)) + (len(data) / self.bandwidth if self.bandwidth else 0.0)
+        self.link_free[link] = sent
+        arrival = sent + self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        # a link is a stream, so jitter never reorders its writes
+        arrival = max(arrival, self.last_delivery.get(link, arrival))
+        self.last_delivery[link] = arrival
+        self.loop.call_at(arrival, reader.feed_data, data)
+
+class Simulation:
+    """N nodes of one protocol in a single process, on a virtual clock and a virtual network."""
+    def __init__(self, module, nodes_num, max_faulty_nodes, base_port=5060, verbose=False, seed=0, **network_options):
+        self.module = module
+        self.nodes_num = nodes_num
+        self.base_port = base_port
+        self.verbose = verbose
+        self.devnull = open(os.devnull, "w")
+        random.seed(seed) # the BSMR replicas draw their replies from the random module
+        module.max_faulty_nodes = max_faulty_nodes
+        module.verification_workers = 0 # everything runs on one thread
+        if hasattr(module, "configure_logging"): # PBFT logs, the BSMR scripts print
+            if verbose: module.configure_logging(logging.DEBUG)
+            else: module.logger.setLevel(logging.CRITICAL)
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.network = VirtualNetwork(self.loop, seed=seed, **network_options)
+        with self.output():
+            self.nodes = [self.create_node(i) for i in range(nodes_num)]
+
+    def create_node(self, node_id):
+        raise NotImplementedError
+
+    def attach(self, endpoint, address):
+        """run a node or client on the simulation's loop and route its connections through the virtual network."""
+        endpoint.loop = self.loop
+        endpoint.open_connection = lambda host, port: self.network.open_connection(address, host, port)
+        endpoint.start_server = lambda callback, host, port: self.network.start_server(address, callback, host, port)
+        return endpoint
+
+    def output(self):
+        """the nodes print or log every message; unless verbose, that output is discarded."""
+        if self.verbose: return contextlib.nullcontext()
+        return contextlib.redirect_stdout(self.devnull)
+
+    def run(self, coroutine):
+        """run a coroutine on the virtual clock and return its result."""
+        with self.output():
+            return self.loop.run_until_complete(coroutine)
+
+    def run_for(self, duration):
+        """advance the virtual clock by duration seconds, processing everything that happens meanwhile."""
+        self.run(asyncio.sleep(duration))
+
+    def close(self):
+        """stop the connection handlers that are still waiting for data and close the loop."""
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks: task.cancel()
+        self.run(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close(); self.devnull.close()
+
+    async def connect(self):
+        """start all the nodes and connect every pair, as the nodes' own __main__ does over TCP."""
+        for node in self.nodes:
+            await node.listen_for_connections('localhost', self.base_port + node.node_id)
+        for node in self.nodes:
+            for peer in self.nodes:
+                if peer is not node: await node.connect_to_peer('localhost', self.base_port + peer.node_id)
+        await asyncio.sleep(1)
+
+class PBFTSimulation(Simulation):
+    def create_node(self, node_id):
+        node = self.attach(self.module.Node(node_id=node_id, nodes_num=self.nodes_num), node_id)
+        node.base_port = self.base_port
+        return node
+
+    def create_client(self, client_id):
+        return self.attach(self.module.Client(client_id=client_id, nodes_num=self.nodes_num), client_id)
+
+    async def run_clients(self, clients_num, operations_per_client, reads):
+        """closed-loop clients: each one waits for the reply to a request before sending the next; a
+        fraction reads of the requests are read-only."""
+        latencies = []
+        async def client_loop(client):
+            for replica in self.nodes:
+                await client.connect_to_replica('localhost', self.base_port + replica.node_id, replica.node_id)
+            await asyncio.sleep(0.1)
+            for operation in range(operations_per_client):
+                start = self.loop.time()
+                if reads and self.network.random.random() < reads: await client.send_read()
+                else: await client.send_request((operation % 9) + 1)
+                latencies.append(self.loop.time() - start)
+        clients = [self.create_client(j) for j in range(clients_num)]
+        await asyncio.gather(*[client_loop(client) for client in clients])
+        return latencies
+
+    def workload(self, clients_num, operations_per_client, reads=0.0):
+        self.run(self.connect())
+        start = self.loop.time()
+        latencies = self.run(self.run_clients(clients_num, operations_per_client, reads))
+        self.run_for(1) # let the replicas that lag behind the f + 1 fastest ones catch up
+        return start, latencies
+
+class BSMRSimulation(Simulation):
+    def create_node(self, node_id):
+        return self.attach(self.module.Node(node_id=node_id, nodes_num=self.nodes_num,
+                                            node_port=self.base_port + node_id), node_id)
+
+    def workload(self, clients_num, operations_per_client, reads=0.0):
+        """the BSMR replicas run their own driver: one proposal every 3 seconds after a 6 second start."""
+        operations = [(operation % 9) + 1 for operation in range(operations_per_client)]
+        for node in self.nodes: node.operations = operations
+        self.run(self.connect())
+        start = self.loop.time()
+        for node in self.nodes: self.loop.create_task(node.check_if_is_primary())
+        self.run_for(6 + 3 * len(operations) + 2)
+        return start, []
+
+def percentile(values, fraction):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def simulate(protocol, nodes_num, max_faulty_nodes, clients_num=1, operations_per_client=4, partition=None, collector=False, reads=0.0, **options):
+    """run one simulated cluster and summarise it."""
+    module = load_protocol(protocol)
+    if protocol == "pbft": module.collector_mode = collector
+    simulation_class = PBFTSimulation if protocol == "pbft" else BSMRSimulation
+    wall_start = time.perf_counter()
+    simulation = simulation_class(module, nodes_num, max_faulty_nodes, **options)
+    if partition:
+        groups, partition_start, partition_end = partition
+        simulation.loop.call_at(partition_start, simulation.network.partition, groups)
+        simulation.loop.call_at(partition_end, simulation.network.heal)
+    start, latencies = simulation.workload(clients_num, operations_per_client, reads)
+    virtual_time = simulation.loop.time() - start
+    states = [node.state for node in simulation.nodes]
+    simulation.close()
+    return {"protocol": protocol, "nodes": nodes_num, "f": max_faulty_nodes,
+            "operations": len(latencies), "virtual_seconds": round(virtual_time, 6),
+            "throughput": round(len(latencies) / virtual_time, 3) if latencies else None,
+            "latency_p50": percentile(latencies, 0.5), "latency_p99": percentile(latencies, 0.99),
+            "messages": simulation.network.messages, "bytes": simulation.network.bytes, "dropped": simulation.network.dropped,
+            "distinct_states": len(set(states)), "state": max(set(states), key=states.count),
+            # replicas that lag behind still hold a prefix of the longest state; anything else is a fork
+            "forked": any(not max(states, key=len).startswith(state) for state in states),
+            "wall_seconds": round(time.perf_counter() - wall_start, 3)}
+
+def parse_partition(text):
+    """'0,1/2,3@5:20' keeps {0, 1} and {2, 3} apart from virtual second 5 to 20."""
+    groups, times = text.split("@")
+    partition_start, partition_end = times.split(":")
+    return ([[int(node) for node in group.split(",")] for group in groups.split("/")], float(partition_start), float(partition_end))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="simulate a PBFT or BSMR cluster on a virtual clock")
+    parser.add_argument("protocol", choices=sorted(PROTOCOLS))
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--f", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--operations", type=int, default=4, help="operations per client (BSMR: rounds)")
+    parser.add_argument("--latency", type=float, default=0.001, help="one-way latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per link")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a message is dropped")
+    parser.add_argument("--partition", type=parse_partition, default=None, help="e.g. 0,1/2,3@5:20")
+    parser.add_argument("--collector", action="store_true", help="PBFT: send the votes through the primary as collector")
+    parser.add_argument("--reads", type=float, default=0.0, help="PBFT: fraction of the requests that are read-only")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    result = simulate(args.protocol, args.nodes, args.f, args.clients, args.operations, args.partition, args.collector, args.reads,
+                      latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth, loss=args.loss,
+                      seed=args.seed, verbose=args.verbose)
+    for key, value in result.items(): print(f"{key:>16}: {value}")
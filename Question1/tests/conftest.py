@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+import pytest
+
+QUESTION1_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, QUESTION1_DIR)
+
+import simulator
+
+@pytest.fixture(scope="session")
+def keystore(tmp_path_factory):
+    """one keystore for the whole session, so every key is generated once."""
+    return str(tmp_path_factory.mktemp("keys"))
+
+@pytest.fixture
+def pbft(keystore):
+    """a fresh PBFT module with an honest primary and its keys in the temporary keystore."""
+    module = simulator.load_protocol("pbft")
+    module.keystore_dir = keystore; module.malicious_primary = -1
+    return module
+
+@pytest.fixture
+def cluster(pbft):
+    """start(...) connects a simulated PBFT cluster (4 replicas, f = 1 by default); every cluster is closed after the test."""
+    simulations = []
+    def start(module=pbft, nodes_num=4, max_faulty_nodes=1, **network_options):
+        simulation = simulator.PBFTSimulation(module, nodes_num, max_faulty_nodes, **network_options)
+        simulations.append(simulation)
+        simulation.run(simulation.connect())
+        return simulation
+    yield start
+    for simulation in simulations: simulation.close()
+
+async def connect_client(simulation, client_id):
+    """a client connected to every replica of the simulation."""
+    client = simulation.create_client(client_id)
+    for replica in simulation.nodes:
+        await client.connect_to_replica('localhost', simulation.base_port + replica.node_id, replica.node_id)
+    await asyncio.sleep(0.1)
+    return client
+
+def states(simulation):
+    return [node.state for node in simulation.nodes]
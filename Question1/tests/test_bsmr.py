@@ -0,0 +1,17 @@
+import pytest
+import simulator
+
+@pytest.mark.parametrize("protocol", ["bsmr1", "bsmr2"])
+def test_equivocating_primary_forks_bsmr(protocol, keystore):
+    module = simulator.load_protocol(protocol)
+    module.keystore_dir = keystore
+    simulation = simulator.BSMRSimulation(module, 4, 1)
+    latencies = []
+    for node in simulation.nodes: node.on_decision = lambda proposed_at, decided_at: latencies.append(decided_at - proposed_at)
+    simulation.workload(1, 4)
+    states = [node.state for node in simulation.nodes]
+    simulation.close()
+    # unlike PBFT, nothing stops the malicious primary from telling the replicas different next states
+    assert len(set(states)) > 1
+    # the primary decides on the f + 1st reply: one round trip of the 1 ms network
+    assert len(latencies) == 4 and max(latencies) < 0.01
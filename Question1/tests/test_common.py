@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+import common
+import simulator
+
+def frame(body):
+    return common.FRAME_HEADER.pack(len(body)) + body
+
+def test_frame_decoder_joins_split_frames():
+    decoder = common.FrameDecoder()
+    data = frame(b'{"a":1}') + frame(b'{"b":2}')
+    assert decoder.feed(data[:3]) == []
+    assert decoder.feed(data[3:11]) == [{"a": 1}]
+    assert decoder.feed(data[11:]) == [{"b": 2}]
+    assert not decoder.buffer
+
+def test_frame_decoder_refuses_oversized_frames():
+    decoder = common.FrameDecoder(max_frame=16)
+    with pytest.raises(ValueError):
+        decoder.feed(common.FRAME_HEADER.pack(17)) # refused before its body arrives
+
+def test_frame_decoder_refuses_undecodable_frames():
+    with pytest.raises(ValueError):
+        common.FrameDecoder().feed(frame(b"junk!"))
+
+def test_timer_wheel():
+    loop = simulator.VirtualClockLoop()
+    wheel = common.TimerWheel(loop, 0.01, 8)
+    fired = []
+    for delay in (0.05, 0.021, 1.5): wheel.call_later(delay, lambda delay=delay: fired.append((delay, round(loop.time(), 3))))
+    cancelled = wheel.call_later(0.03, fired.append, "cancelled")
+    cancelled.cancel()
+    loop.run_until_complete(asyncio.sleep(2))
+    loop.close()
+    # each timeout runs at the first tick at or after its deadline, even more than one turn of the wheel ahead
+    assert fired == [(0.021, 0.03), (0.05, 0.05), (1.5, 1.5)]
+    assert wheel.pending == 0
+
+def test_write_ahead_log_recovers_the_snapshot_and_the_records_after_it(tmp_path):
+    async def write():
+        wal = common.WriteAheadLog(str(tmp_path), "node", asyncio.get_running_loop())
+        for i in range(3): wal.append({"i": i})
+        wal.snapshot({"upto": 2})
+        for i in range(3, 5): wal.append({"i": i})
+        synced = asyncio.get_running_loop().create_future()
+        wal.after_sync(synced.set_result, None)
+        await synced
+        wal.close()
+        return wal.segment_path(wal.segment)
+    last_segment = asyncio.run(write())
+    # a record torn by a crash ends the log
+    with open(last_segment, "ab") as segment_file: segment_file.write(common.WAL_RECORD_HEADER.pack(100, 0) + b'{"i":')
+    wal = common.WriteAheadLog(str(tmp_path), "node", None)
+    snapshot, records = wal.load()
+    wal.close()
+    assert snapshot["upto"] == 2
+    assert records == [{"i": 3}, {"i": 4}]
+
+def test_write_ahead_log_fails_stop(tmp_path):
+    directory = tmp_path / "wal"
+    async def write():
+        loop = asyncio.get_running_loop()
+        wal = common.WriteAheadLog(str(directory), "node", loop, report=lambda message: None)
+        directory.rmdir() # the first group cannot open its segment
+        released = []
+        wal.append({"i": 0}); wal.after_sync(released.append, 0)
+        await asyncio.sleep(0.1)
+        directory.mkdir()
+        # a later group could be written, but it must not release anything that waited for the lost one
+        wal.append({"i": 1}); wal.after_sync(released.append, 1)
+        await asyncio.sleep(0.1)
+        wal.close()
+        return wal, released
+    wal, released = asyncio.run(write())
+    assert released == [] and wal.failure is not None
+    assert not list(directory.iterdir())
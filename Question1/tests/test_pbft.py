@@ -0,0 +1,214 @@
+import asyncio
+import base64
+import logging
+import random
+from cryptography.hazmat.primitives import serialization
+import common
+from conftest import connect_client, states
+
+def run_requests(simulation, operations, reads=0.0):
+    simulation.run(simulation.run_clients(1, operations, reads))
+    simulation.run_for(1)
+
+def test_honest_primary_orders_the_requests(cluster):
+    simulation = cluster()
+    run_requests(simulation, 4)
+    assert states(simulation) == ["$1234"] * 4
+
+def test_equivocating_primary_is_replaced(pbft, cluster):
+    pbft.malicious_primary = 0
+    simulation = cluster()
+    run_requests(simulation, 4)
+    # the backups refuse the operations the primary altered, since their clients did not sign them, so the
+    # request is ordered as the client sent it once view 1 is installed
+    assert states(simulation) == ["$1234"] * 4
+    assert all(node.view == 1 and node.view_active for node in simulation.nodes)
+
+def test_collector_mode(pbft, cluster):
+    pbft.collector_mode = True
+    simulation = cluster()
+    run_requests(simulation, 4)
+    assert states(simulation) == ["$1234"] * 4
+
+def test_reads_are_not_ordered(cluster):
+    simulation = cluster()
+    async def write_then_read():
+        client = await connect_client(simulation, 0)
+        for operation in (1, 2): await client.send_request(operation)
+        await asyncio.sleep(0.1)
+        ordered = [node.seq_no for node in simulation.nodes]
+        return await client.send_read(), ordered
+    state, ordered = simulation.run(write_then_read())
+    assert state == "$12"
+    assert [node.seq_no for node in simulation.nodes] == ordered
+
+def test_lost_request_is_ordered_after_a_later_one(cluster):
+    simulation = cluster()
+    primary = simulation.nodes[0]
+    receive_request, lost = primary.receive_request, []
+    def lose_first_request(message):
+        if message.fields["t"] == 1 and not lost: lost.append(message)
+        else: receive_request(message)
+    primary.receive_request = lose_first_request
+    async def two_outstanding():
+        client = await connect_client(simulation, 0)
+        return await asyncio.wait_for(asyncio.gather(client.send_request(1), client.send_request(2)), 60)
+    # request 1 is ordered after request 2 once the client retransmits it, and both are answered
+    assert simulation.run(two_outstanding()) == ["$21", "$2"]
+    assert states(simulation) == ["$21"] * 4
+
+def test_messages_that_name_another_sender_are_dropped(cluster):
+    simulation = cluster()
+    evil, target = simulation.nodes[3], simulation.base_port + 1
+    request = evil.sign_message({"phase": "REQUEST", "message": [{"o": 9, "t": 1, "c": "client-x"}]})
+    # replica 3 pretends to be the primary of view 0 and votes on behalf of every replica
+    evil.send_message(target, evil.sign_message({"phase": "PRE-PREPARE", "v": 0, "n": 2, "d": request.digest}, request))
+    for i in range(4):
+        evil.send_message(target, evil.authenticate({"phase": "PREPARE", "v": 0, "n": 2, "d": request.digest, "i": i}))
+        evil.send_message(target, evil.authenticate({"phase": "COMMIT", "v": 0, "n": 2, "d": request.digest, "i": i}))
+    simulation.run_for(1)
+    assert states(simulation) == ["$"] * 4
+    assert simulation.nodes[1].metrics_snapshot()["counters"]["pbft_forged_messages_total"] > 0
+
+def test_one_replica_cannot_start_a_view_change(cluster):
+    simulation = cluster()
+    evil = simulation.nodes[3]
+    evil.start_view_change(1)
+    # a VIEW-CHANGE in the name of replica 2 would make f + 1 senders, but it does not come from replica 2
+    evil.broadcast_message(evil.sign_message({"phase": "VIEW-CHANGE", "v": 1, "n": evil.h, "C": [], "P": [], "Q": [], "i": 2}))
+    simulation.run_for(1)
+    assert [node.view for node in simulation.nodes[:3]] == [0, 0, 0]
+
+def test_a_faulty_replica_cannot_fill_the_logs(cluster):
+    simulation = cluster()
+    evil, judge = simulation.nodes[3], simulation.nodes[1]
+    for v in range(1, 50):
+        evil.send_message(simulation.base_port + 1, evil.sign_message({"phase": "VIEW-CHANGE", "v": v, "n": evil.h, "C": [], "P": [], "Q": [], "i": 3}))
+    for n in range(5, 5000, 5):
+        evil.send_message(simulation.base_port + 1, evil.sign_message({"phase": "CHECKPOINT", "n": n, "d": "x", "v": 0, "i": 3}))
+    simulation.run_for(1)
+    # only the latest VIEW-CHANGE of a sender counts, and it keeps one CHECKPOINT per sequence number up to the next window
+    assert list(judge.view_changes) == [49]
+    assert len(judge.checkpoints) == (judge.H + (judge.H - judge.h)) // 5 + 1
+
+def test_prepared_certificate_needs_2f_prepares(pbft, cluster):
+    simulation = cluster()
+    evil, judge = simulation.nodes[1], simulation.nodes[2]
+    request = pbft.Message({"phase": "REQUEST", "message": [{"o": 9, "t": 1, "c": "client-x"}]})
+    # replica 1, the primary of view 1, signs a PRE-PREPARE that no replica prepared
+    preprepare = evil.sign_message({"phase": "PRE-PREPARE", "v": 1, "n": 2, "d": request.digest}, request)
+    def view_change(node, prepares=()):
+        P = [preprepare.to_json()] if node is evil else []
+        return node.sign_message({"phase": "VIEW-CHANGE", "v": 2, "n": pbft.h, "C": [], "P": P,
+                                  "Q": [prepare.to_json() for prepare in prepares], "i": node.node_id})
+    def prepare(node):
+        return node.sign_message({"phase": "PREPARE", "v": 1, "n": 2, "d": request.digest, "i": node.node_id})
+    others = [view_change(simulation.nodes[0]), view_change(simulation.nodes[3])]
+    assert judge.compute_new_view([view_change(evil)] + others)[1] == {}
+    # the primary's own PREPARE does not count
+    assert judge.compute_new_view([view_change(evil, [prepare(evil), prepare(simulation.nodes[0])])] + others)[1] == {}
+    chosen = judge.compute_new_view([view_change(evil, [prepare(simulation.nodes[0]), prepare(simulation.nodes[3])])] + others)[1]
+    assert chosen[2].digest == request.digest
+
+def test_cut_off_replica_rejoins_the_view(cluster):
+    simulation = cluster(latency=0.05)
+    simulation.loop.call_at(5, simulation.network.partition, [[0, 1, 2], [3]])
+    simulation.loop.call_at(20, simulation.network.heal)
+    run_requests(simulation, 200)
+    simulation.run_for(5)
+    # replica 3 suspected its way into views that never formed, fetched the state and fell back to view 0
+    assert len(set(states(simulation))) == 1
+    lagging = simulation.nodes[3]
+    assert (lagging.view, lagging.view_active, lagging.view_change_backoff, lagging.new_view_timer) == (0, True, 0, None)
+    assert lagging.metrics_snapshot()["counters"]["pbft_state_transfers_total"] > 0
+
+def test_new_view_makes_its_checkpoint_stable(cluster):
+    simulation = cluster()
+    lagging = simulation.nodes[3]
+    log_checkpoint = lagging.log_checkpoint
+    # every CHECKPOINT of the other replicas is lost on the way to replica 3
+    lagging.log_checkpoint = lambda message: log_checkpoint(message) if message.i == 3 else None
+    run_requests(simulation, 10)
+    assert [node.h for node in simulation.nodes] == [10, 10, 10, 1]
+    for node in simulation.nodes: node.start_view_change(1)
+    simulation.run_for(1)
+    # the checkpoint proven by the VIEW-CHANGE messages is stable at replica 3 too once it installs view 1
+    assert [(node.view, node.h, node.H) for node in simulation.nodes] == [(1, 10, 29)] * 4
+
+def test_lossy_network(cluster):
+    simulation = cluster(loss=0.05)
+    simulation.run(simulation.run_clients(4, 25, 0.0))
+    simulation.run_for(30)
+    # lost CHECKPOINTs and VIEW-CHANGEs leave no replica behind on an old window
+    assert len(set(states(simulation))) == 1 and len(states(simulation)[0]) == 101
+    assert len({(node.h, node.H, node.last_executed) for node in simulation.nodes}) == 1
+
+def test_client_cannot_take_over_keys(cluster, tmp_path):
+    simulation = cluster()
+    node = simulation.nodes[1]
+    public_keys = dict(node.public_keys)
+    other = common.load_private_key(str(tmp_path), "other", "ed25519").public_key()
+    pem = base64.b64encode(other.public_bytes(serialization.Encoding.PEM,
+                                              serialization.PublicFormat.SubjectPublicKeyInfo)).decode()
+    async def handshakes():
+        client = await connect_client(simulation, 0)
+        await client.send_request(1)
+        # a client claiming a replica's id, a second key for client-0 and a second key for replica 2
+        for fields in ({"phase": "HANDSHAKE", "public-key": pem, "id": 0, "client": True},
+                       {"phase": "HANDSHAKE", "public-key": pem, "id": "client-0", "client": True},
+                       {"phase": "HANDSHAKE", "public-key": pem, "id": 2}):
+            reader, writer = await simulation.network.open_connection("other", "localhost", simulation.base_port + 1)
+            writer.write(simulation.module.encode_frame(simulation.module.Message(fields)))
+            await asyncio.sleep(0.1)
+        await client.send_request(2)
+    simulation.run(handshakes())
+    simulation.run_for(1)
+    assert node.public_keys == public_keys and list(node.client_keys) == ["client-0"]
+    assert states(simulation) == ["$12"] * 4
+
+def test_bad_frames_only_drop_their_connection(cluster):
+    simulation = cluster()
+    async def send_bad_frames():
+        reader, writer = await simulation.network.open_connection("other", "localhost", simulation.base_port + 1)
+        writer.write(common.FRAME_HEADER.pack(5) + b"junk!")
+        reader, writer = await simulation.network.open_connection("other", "localhost", simulation.base_port + 2)
+        writer.write(common.FRAME_HEADER.pack(common.MAX_FRAME + 1))
+        await asyncio.sleep(0.1)
+    simulation.run(send_bad_frames())
+    run_requests(simulation, 4)
+    assert states(simulation) == ["$1234"] * 4
+
+def test_replica_recovers_from_its_write_ahead_log(pbft, tmp_path):
+    # the log needs real time for its fsyncs, so this cluster runs over TCP on a real event loop
+    pbft.wal_dir = str(tmp_path); pbft.max_faulty_nodes = 1; pbft.verification_workers = 0
+    pbft.logger.setLevel(logging.CRITICAL)
+    base_port = random.randint(20000, 40000)
+    def create_node(loop, node_id):
+        node = pbft.Node(node_id=node_id, nodes_num=4)
+        node.loop = loop; node.base_port = base_port
+        node.recover()
+        return node
+    async def run():
+        loop = asyncio.get_running_loop()
+        nodes = [create_node(loop, i) for i in range(4)]
+        for node in nodes: await node.listen_for_connections('localhost', base_port + node.node_id)
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node: await node.connect_to_peer('localhost', base_port + peer.node_id)
+        client = pbft.Client(client_id=0, nodes_num=4)
+        client.loop = loop
+        for node in nodes: await client.connect_to_replica('localhost', base_port + node.node_id, node.node_id)
+        for operation in (1, 2, 3, 4, 5, 6, 7): await client.send_request(operation)
+        await asyncio.sleep(0.5)
+        # replica 3 restarts from its snapshot-less log and must come back exactly as it was
+        restarted = create_node(loop, 3)
+        summary = lambda node: (node.state, node.last_executed, node.view, node.h, node.reply_timestamps())
+        result = summary(restarted), summary(nodes[3])
+        client.close()
+        for node in nodes + [restarted]:
+            node.wal.close()
+            if hasattr(node, "server"): node.server.close()
+        return result
+    recovered, running = asyncio.run(run())
+    assert recovered == running
+    assert recovered[:2] == ("$1234567", 8)
@@ -1,6 +1,7 @@
-import socket
+import asyncio
 import threading
 import time
+import os
 import json
 import hashlib
 import sys
@@ -10,8 +11,17 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.asymmetric import utils
 from cryptography.hazmat.primitives import serialization
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Question1"))
+from common import FRAME_HEADER, RECV_BUFFER_SIZE, FrameDecoder, TimerWheel
 GREEN = "\033[92m"; RED = "\033[91m"; BLUE = "\033[34m"; RESET = "\033[0m"
 
+TIMER_TICK = 0.01; TIMER_SLOTS = 1024
+
+def encode_frame(json_message):
+    """encode a message as a 4-byte big-endian length followed by its json bytes."""
+    payload = json.dumps(json_message).encode('utf-8')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
 class Node:
     def __init__(self, node_id, nodes_num, node_port):
         self.node_id = node_id
@@ -26,30 +36,45 @@ class Node:
         self.deposit_value = 0
 
     def start(self, host, port):
-        """start the node and listen for incoming connections."""
-        server_thread = threading.Thread(target=self.listen_for_connections, args=(host, port))
-        server_thread.start()
-
-    def listen_for_connections(self, host, port):
-        """listen for incoming messages from other nodes."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(10)
+        """start the node's event loop and listen for incoming connections."""
+        self.loop = asyncio.new_event_loop()
+        self.timer_wheel = TimerWheel(self.loop, TIMER_TICK, TIMER_SLOTS)
+        threading.Thread(target=self.loop.run_forever, args=()).start()
+        self.call(self.listen_for_connections, host, port)
+
+    def call(self, function, *args):
+        """run a function or coroutine on the node's event loop from another thread and wait for its result."""
+        async def invoke():
+            result = function(*args)
+            if asyncio.iscoroutine(result): result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(invoke(), self.loop).result()
+
+    async def listen_for_connections(self, host, port):
+        """listen for incoming connections from other nodes."""
+        self.server = await asyncio.start_server(self.handle_message, host, port)
         print(f"Node {self.node_id} is listening on port {port}")
-        while True:
-            conn, addr = server_socket.accept()
-            ip_, port_ = addr
-            threading.Thread(target=self.handle_message, args=(conn,)).start()
-        print(f"Node {self.node_id} is no longer listening on port {port}")
     
-    def handle_message(self, conn):
-        """receive the messages from other nodes."""
+    async def receive_frames(self, reader):
+        """yield the messages arriving on a connection as the stream delivers them."""
+        decoder = FrameDecoder()
         while True:
-            message = conn.recv(1024).decode('utf-8')
-            message = json.loads(message)
-            print(f"Node {self.node_id} received message: {message}")
-            # process each message based on its type and the state of the protocol
-            threading.Thread(target=self.process_message, args=(message,)).start()
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data: return
+            for message in decoder.feed(data): yield message
+
+    async def handle_message(self, reader, writer):
+        """receive the messages from other nodes."""
+        try:
+            async for message in self.receive_frames(reader):
+                print(f"Node {self.node_id} received message: {message}")
+                # process each message based on its type and the state of the protocol; a message that
+                # breaks its handler is dropped, and the connection goes on with the next one
+                try: await self.process_message(message)
+                except Exception as e: print(f"{RED}Node {self.node_id} failed to process {message}: {e!r}{RESET}")
+        except ValueError as e: # an oversized or undecodable frame: the rest of the stream cannot be trusted
+            print(f"{RED}Node {self.node_id} dropped a connection: {e}{RESET}")
+            writer.close()
     
     def generate_HTLC_condition(self):
         """generate an HTLC condition such that condition = H(random_128_bit_number)."""
@@ -73,9 +98,8 @@ class Node:
         if not self.deposit_for_HTLC(bt):   
             print("No enough liqidity to establish HTLC!"); return 
         self.deposit_value = bt
-        self.next_timer = threading.Timer(timeout, self.take_back_money, args=(bt,)) 
         self.send_message(peer_port, json_message)
-        self.next_timer.start()
+        self.next_timer = self.timer_wheel.call_later(timeout, self.take_back_money, bt)
         print(f"Node {self.node_id} will pay node {self.node_id+1} {bt} bitcoin iff it provide pre-image in {timeout} seconds")
 
     def deposit_for_HTLC(self, bt):
@@ -105,7 +129,7 @@ class Node:
         if timer: return False
         return True
 
-    def process_message(self, json_message):
+    async def process_message(self, json_message):
         """process the message based on the message type."""
         type = json_message["type"]
 
@@ -125,8 +149,7 @@ class Node:
             condition = json_message["condition"]
             timeout = json_message["timeout"]
             bitcoin = json_message["bitcoin"]
-            self.last_timer = threading.Timer(timeout, self.connection_expire, args=()) 
-            self.last_timer.start()
+            self.last_timer = self.timer_wheel.call_later(timeout, self.connection_expire)
             print(f"I need to provide the node {self.node_id - 1} with the pre-image before {timeout} seconds")
             # if self.node_id == 3: time.sleep(7)
             # if it already has pre-image, release it and reedeem money:
@@ -154,12 +177,11 @@ class Node:
             self.send_message((self.node_port - self.node_id) + 1, json_message)
         else: print("Invalid message!")
 
-    def connect_to_peer(self, peer_host, peer_port):
+    async def connect_to_peer(self, peer_host, peer_port):
         """connect to a peer node."""
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((peer_host, peer_port))
-            self.peers[peer_port] = peer_socket
+            reader, writer = await asyncio.open_connection(peer_host, peer_port)
+            self.peers[peer_port] = writer
             print(f"Node {self.node_id} connected to peer {peer_port}")
         except Exception as e:
             print(f"{RED}Node {self.node_id} failed to connect to peer {peer_port}: {e}{RESET}")
@@ -167,7 +189,7 @@ class Node:
     def send_message(self, peer_port, json_message):
         """send a message to a peer."""
         try:
-            self.peers[peer_port].sendall(json.dumps(json_message).encode('utf-8'))
+            self.peers[peer_port].write(encode_frame(json_message))
             print(f"{BLUE}Node {self.node_id} sent message to peer {peer_port}: {json_message}{RESET}")
         except Exception as e:
             print(f"{RED}Failed to send message to peer {peer_port}: {e}{RESET}")                    
@@ -189,14 +211,14 @@ if __name__ == '__main__':
     # connect nodes to each other
     for i in range(1, nodes_num + 1):
         if i != node_id:
-            node.connect_to_peer('localhost', base_port + i)
+            node.call(node.connect_to_peer, 'localhost', base_port + i)
 
     time.sleep(7)
     execution_time = []
     if node_id == 1: 
         for i in range(2):
             start_time = time.time()
-            node.pay_bitcoin(1)
+            node.call(node.pay_bitcoin, 1)
             end_time = time.time()
             execution_time.append(end_time - start_time)
             time.sleep(5)